@@ -0,0 +1,225 @@
+"""
+Benchmarks of the NLP loader on synthetic files written with write_NLP.
+
+Run with asv run, the files are generated once and kept in PYLEEM_BENCH_DIR (default: a pyLEEM_bench folder in the
+temporary directory). PYLEEM_BENCH_MB sets the size of the decoded stack in MB (default 256), e.g.
+PYLEEM_BENCH_MB=20000 asv run for files of tens of GB.
+"""
+import numpy as np
+import os
+import tempfile
+import time
+import tracemalloc
+import zlib
+from pyLEEM.LEEMAnalysis import (load_header, read_directory, load_NLP, iter_frames, decode_frame, decode_deltas,
+                                 read_image_block, stream_frame, DIRECTORY_DTYPE)
+from pyLEEM.NLPWriter import write_NLP
+
+BENCH_DIR = os.environ.get('PYLEEM_BENCH_DIR', os.path.join(tempfile.gettempdir(), 'pyLEEM_bench'))
+BENCH_MB = float(os.environ.get('PYLEEM_BENCH_MB', 256))
+HEIGHT, WIDTH = 1024, 1280
+
+
+def synthetic_frames(number_of_frames, bits_per_pixel, seed=0):
+    """
+    Yields smooth frames with shot noise, which compress about like real measurements.
+    """
+    rng = np.random.default_rng(seed)
+    dtype = np.uint8 if bits_per_pixel == 8 else np.uint16
+    y, x = np.mgrid[:HEIGHT, :WIDTH]
+    scale = 100 if bits_per_pixel == 8 else 20000
+    background = scale * (1 + np.sin(x / 97.) * np.cos(y / 61.)) / 2 + 10
+    for i in range(number_of_frames):
+        yield rng.poisson(background * (1 + 0.1 * np.sin(i / 5.))).clip(0, np.iinfo(dtype).max).astype(dtype)
+
+
+def synthetic_file(bits_per_pixel, compression):
+    """
+    Returns the path of the synthetic measurement, writing it on first use.
+    """
+    number_of_frames = max(1, int(BENCH_MB * 2 ** 20 / (HEIGHT * WIDTH * (bits_per_pixel // 8))))
+    path = os.path.join(BENCH_DIR, '{}frames_{}bit_{}.nlp'.format(
+        number_of_frames, bits_per_pixel, 'zlib' if compression else 'raw'))
+    if not os.path.exists(path):
+        os.makedirs(BENCH_DIR, exist_ok=True)
+        write_NLP(path + '.tmp', synthetic_frames(number_of_frames, bits_per_pixel), compression=compression,
+                  bits_per_pixel=bits_per_pixel, meta_data={'GUN_HV': 15000., 'LNS': 'Bright',
+                                                            'STV': np.arange(number_of_frames) * 0.1})
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def stage_rates(path):
+    """
+    Times the directory, metadata and decode stages of path once and returns their MB/s and frames/s.
+
+    The directory stage reads the DIR00 block, the metadata stage the headers of the IMG00 blocks and the decode
+    stage produces the decoded frames, the MB are counted accordingly.
+    """
+    header = load_header(path, verbose=False)
+    start = time.perf_counter()
+    directory = read_directory(path, header.attrs['directory_position'])
+    seconds = {'directory': time.perf_counter() - start}
+    start = time.perf_counter()
+    dataset = load_NLP(path, frame_loading='none')
+    seconds['meta_data'] = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in iter_frames(path, readahead=True):
+        pass
+    seconds['decode'] = time.perf_counter() - start
+
+    blocks = directory['block_start_location'][directory['content_code'] == 1].astype(np.int64)
+    size = {'directory': 13 + len(directory) * DIRECTORY_DTYPE.itemsize,
+            'meta_data': int((dataset.image_address.values - blocks).sum()),
+            'decode': int((dataset.width * dataset.height * dataset.bits_per_pixel // 8).sum())}
+    number_of_frames = dataset.sizes['time']
+    return {stage: (size[stage] / 2 ** 20 / seconds[stage], number_of_frames / seconds[stage]) for stage in seconds}
+
+
+class LoadNLP:
+    params = ([8, 16], [True, False])
+    param_names = ['bits_per_pixel', 'compression']
+    timeout = 3600
+
+    def setup_cache(self):
+        # every file is decoded once for all throughputs instead of once per track benchmark
+        return {(bits_per_pixel, compression): stage_rates(synthetic_file(bits_per_pixel, compression))
+                for bits_per_pixel in self.params[0] for compression in self.params[1]}
+
+    def setup(self, rates, bits_per_pixel, compression):
+        self.path = synthetic_file(bits_per_pixel, compression)
+        self.header = load_header(self.path, verbose=False)
+        self.rates = rates[bits_per_pixel, compression]
+
+    def time_header(self, rates, bits_per_pixel, compression):
+        load_header(self.path, verbose=False)
+
+    def time_directory(self, rates, bits_per_pixel, compression):
+        read_directory(self.path, self.header.attrs['directory_position'])
+
+    def time_meta_data(self, rates, bits_per_pixel, compression):
+        load_NLP(self.path, frame_loading='none')
+
+    def time_decode(self, rates, bits_per_pixel, compression):
+        for _ in iter_frames(self.path, readahead=True):
+            pass
+
+    def track_directory_MB_per_second(self, rates, bits_per_pixel, compression):
+        return self.rates['directory'][0]
+    track_directory_MB_per_second.unit = 'MB/s'
+
+    def track_directory_frames_per_second(self, rates, bits_per_pixel, compression):
+        return self.rates['directory'][1]
+    track_directory_frames_per_second.unit = 'frames/s'
+
+    def track_meta_data_MB_per_second(self, rates, bits_per_pixel, compression):
+        return self.rates['meta_data'][0]
+    track_meta_data_MB_per_second.unit = 'MB/s'
+
+    def track_meta_data_frames_per_second(self, rates, bits_per_pixel, compression):
+        return self.rates['meta_data'][1]
+    track_meta_data_frames_per_second.unit = 'frames/s'
+
+    def track_decode_MB_per_second(self, rates, bits_per_pixel, compression):
+        return self.rates['decode'][0]
+    track_decode_MB_per_second.unit = 'MB/s'
+
+    def track_decode_frames_per_second(self, rates, bits_per_pixel, compression):
+        return self.rates['decode'][1]
+    track_decode_frames_per_second.unit = 'frames/s'
+
+    def track_file_MB(self, rates, bits_per_pixel, compression):
+        return os.path.getsize(self.path) / 2 ** 20
+    track_file_MB.unit = 'MB'
+
+
+class DeltaDecode:
+    """
+    Delta reconstruction of 16 MB of decompressed frames, frame by frame against one decode_deltas call.
+    """
+    params = ([32, 128, 1024], [8, 16])
+    param_names = ['frame_size', 'bits_per_pixel']
+
+    def setup(self, frame_size, bits_per_pixel):
+        dtype = np.uint8 if bits_per_pixel == 8 else np.uint16
+        number_of_frames = max(1, 2 ** 24 // (frame_size ** 2 * dtype().itemsize))
+        frames = np.random.default_rng(0).integers(0, np.iinfo(dtype).max, (number_of_frames, frame_size, frame_size),
+                                                   dtype=dtype)
+        self.compressed = [zlib.compress(frame.tobytes(), 1) for frame in frames]
+        self.buffers = [zlib.decompress(block) for block in self.compressed]
+        self.out = np.empty_like(frames)
+
+    def time_frame_loop(self, frame_size, bits_per_pixel):
+        for buffer, frame in zip(self.compressed, self.out):
+            decode_frame(buffer, bits_per_pixel, 3, frame_size, frame_size, out=frame)
+
+    def time_decode_deltas(self, frame_size, bits_per_pixel):
+        decode_deltas([zlib.decompress(block) for block in self.compressed], bits_per_pixel, out=self.out)
+
+    def time_frame_loop_integration(self, frame_size, bits_per_pixel):
+        for buffer, frame in zip(self.buffers, self.out):
+            np.cumsum(np.frombuffer(buffer, dtype=self.out.dtype), dtype=self.out.dtype, out=frame.reshape(-1))
+
+    def time_decode_deltas_integration(self, frame_size, bits_per_pixel):
+        decode_deltas(self.buffers, bits_per_pixel, out=self.out)
+
+
+class StreamFrame:
+    """
+    Decoding of a single compressed 4096 x 4096 frame as a whole against stream_frame.
+    """
+    timeout = 600
+
+    def setup_cache(self):
+        path = os.path.join(BENCH_DIR, '4096x4096_16bit_zlib.nlp')
+        if not os.path.exists(path):
+            os.makedirs(BENCH_DIR, exist_ok=True)
+            frame = np.random.default_rng(0).poisson(2000, (1, 4096, 4096)).astype(np.uint16)
+            write_NLP(path, frame)
+        return path
+
+    def setup(self, path):
+        self.path = path
+        self.image_address = int(load_NLP(path, frame_loading='none').image_address[0])
+        self.out = np.empty((4096, 4096), dtype=np.uint16)
+
+    def decode(self, streamed):
+        if streamed:
+            stream_frame(self.path, self.image_address, 16, self.out)
+        else:
+            decode_frame(read_image_block(self.path, self.image_address), 16, 3, 4096, 4096, out=self.out)
+
+    def peak_memory(self, streamed):
+        tracemalloc.start()
+        try:
+            self.decode(streamed)
+            return tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+
+    def time_decode_frame(self, path):
+        self.decode(False)
+
+    def time_stream_frame(self, path):
+        self.decode(True)
+
+    def track_peak_memory_decode_frame(self, path):
+        return self.peak_memory(False)
+    track_peak_memory_decode_frame.unit = 'MB'
+
+    def track_peak_memory_stream_frame(self, path):
+        return self.peak_memory(True)
+    track_peak_memory_stream_frame.unit = 'MB'
+
+
+class ImportTime:
+    timeout = 120
+
+    def timeraw_import_pyLEEM(self):
+        return "import pyLEEM"
+
+    def timeraw_import_backend(self):
+        return "import pyLEEM.XArrayExt"
+
+    def timeraw_version(self):
+        return "import pyLEEM; pyLEEM.__version__"
@@ -2,28 +2,93 @@ import numpy as np
 import struct
 import zlib
 import os
+import hashlib
 import xarray as xr
 from datetime import datetime
-from tqdm import tqdm
 from collections import defaultdict
+from pyLEEM.NLPCache import read_index_cache, write_index_cache, read_stack_cache, write_stack_cache, frame_cache
+from pyLEEM.NLPReader import open_reader
+from pyLEEM.NLPStats import stage, current
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+from time import monotonic, sleep, perf_counter
 
 
 def read_int(f, n):
     return int.from_bytes(bytearray(f.read(n)), byteorder='little', signed=False)
 
 
-def load_NLP(path, frame_loading="all"):
+# One directory entry: frame number, content code (1 for IMG00 blocks), block position and 26 bytes of padding.
+DIRECTORY_DTYPE = np.dtype([('frame_number', '<u4'), ('content_code', 'u1'), ('block_start_location', '<u4'),
+                            ('padding', 'V26')])
+
+
+def read_directory(f, directory_position):
+    """
+    Reads the DIR00 block of an NLP file in a single pass.
+
+    Parameters
+    ----------
+    f : NLPReader or any source accepted by NLPReader
+        The NLP file, e.g. opened in binary mode.
+    directory_position : int
+        Position of the directory block in the file.
+
+    Returns
+    -------
+    numpy.ndarray
+        Structured array of dtype DIRECTORY_DTYPE with one record per directory entry.
+
+    """
+    with open_reader(f) as reader, stage('directory') as timing:
+        block_size, block_content, number_of_entries = struct.unpack('<I5sI', reader.pread(13, directory_position))
+        entries = bytearray(reader.pread(number_of_entries * DIRECTORY_DTYPE.itemsize, directory_position + 13))
+        timing.bytes_read = 13 + len(entries)
+        # the padding of the last entry may be cut off at the end of the file
+        entries.extend(bytes(number_of_entries * DIRECTORY_DTYPE.itemsize - len(entries)))
+    return np.frombuffer(entries, dtype=DIRECTORY_DTYPE)
+
+
+def load_NLP(path, frame_loading="all", dtype=None, num_workers=1, frames=None, time=None, grab_time=None,
+             memmap=False, index_cache=None, statistics=('min', 'max'), histogram_bins=None, raw_strings=False,
+             collapse_constant=False, stack_cache=None):
     """
     Loads a measurement from path and returns the measurement as an XArray Dataset
 
     Parameters
     ----------
     path : str
-        Path to the measurement file.
+        Path to the measurement file. Anything else accepted by NLPReader works as well, e.g. an open binary file
+        or the bytes of a file. The file is opened once for the header, the metadata and the frames.
     frame_loading : str, optional
         Determines how much data should be loaded.
         The default is 'all'. 'ten' which loads the first and last 5 images.
         'none' loads no images.
+    dtype : numpy dtype, optional
+        dtype of the intensity. The default is None which keeps the native uint8 or uint16 of the file.
+    num_workers : int, optional
+        Number of threads decompressing the frames. The default is 1.
+    frames, time, grab_time : optional
+        Restrict the dataset to a selection of frames before anything is decoded, see select_frames.
+        frame_loading then applies to the selected frames.
+    memmap : bool, optional
+        Map uncompressed frames into memory instead of reading them, see load_frame_data. The default is False.
+    index_cache : bool or str, optional
+        Keep the parsed header, directory and frame metadata in a sidecar index file and reuse it as long as size
+        and modification time of the file do not change. True stores it next to the file as path + '.idx.npz',
+        a str names a directory collecting the index files. The default is None which parses the file every time.
+    statistics, histogram_bins : optional
+        Per frame statistics computed while decoding, see load_frame_data.
+    raw_strings, collapse_constant : bool, optional
+        How the header fields of the frames are stored, see load_frame_meta_data.
+    stack_cache : bool or str, optional
+        Keep all decoded frames in a .npy file, True next to the file as path + '.stack.npy', a str names a
+        directory collecting the stacks. Later loads of all frames in their native dtype map the stack read only
+        into memory instead of decoding the file again. The statistics are stored with the stack, statistics not
+        stored are computed from the mapped stack. The stack is rebuilt once
+        size, modification time, file header or directory of the file change. The default is None which uses no
+        stack.
 
     Raises
     ------
@@ -34,17 +99,97 @@ def load_NLP(path, frame_loading="all"):
     -------
     the dataset
 
+    """
+    with open_reader(path) as reader:
+        options = [raw_strings, collapse_constant]
+        index_cache = index_cache if reader.path is not None else None
+        dataset = read_index_cache(reader.path, index_cache, options) if index_cache else None
+        if dataset is None:
+            dataset = load_header(reader)
+            load_frame_meta_data(dataset, raw_strings, collapse_constant, reader=reader)
+            if index_cache:
+                write_index_cache(dataset, index_cache, options)
+
+        selection = None
+        if frames is not None or time is not None or grab_time is not None:
+            selection = select_frames(dataset, frames, time, grab_time)
+            dataset = dataset.isel(time=selection)
+
+        stack_cache = stack_cache if reader.path is not None and len(dataset.image_address) > 0 else None
+        if stack_cache and dtype is not None and np.dtype(dtype) != frame_dtype(int(dataset.bits_per_pixel.max())):
+            stack_cache = None
+        if frame_loading in 'all' and stack_cache:
+            digest = content_digest(reader, dataset)
+            stack = read_stack_cache(reader.path, stack_cache, digest)
+            if stack is not None:
+                intensity, stored = stack
+                histogram_range = (0, 2 ** int(dataset.bits_per_pixel.max()))
+                names = [statistic + '_counts' for statistic in statistics]
+                if histogram_bins is not None:
+                    names.append('histogram')
+                if selection is not None:
+                    intensity = intensity[selection]
+                if all(name in stored for name in names) and (
+                        histogram_bins is None or stored['histogram'].shape[1] == histogram_bins):
+                    counts = {statistic: stored[statistic + '_counts'] for statistic in statistics}
+                    histogram = stored.get('histogram') if histogram_bins is not None else None
+                    if selection is not None:
+                        counts = {statistic: values[selection] for statistic, values in counts.items()}
+                        histogram = None if histogram is None else histogram[selection]
+                else:
+                    # only the selected frames are touched
+                    counts, histogram = stack_statistics(intensity, statistics, histogram_bins, histogram_range)
+                dataset['intensity'] = (['time', 'y', 'x'], intensity)
+                store_statistics(dataset, counts, histogram, histogram_range)
+            else:
+                # no memory map, the statistics are computed while decoding and stored with the stack
+                dataset = load_frame_data(dataset, num_workers=num_workers, statistics=statistics,
+                                          histogram_bins=histogram_bins, reader=reader)
+                if selection is None:
+                    write_stack_cache(reader.path, dataset.intensity.values, stack_cache, digest, {
+                        name: dataset[name].values for name in dataset.data_vars
+                        if name.endswith('_counts') or name == 'histogram'})
+        elif frame_loading in 'all':
+            dataset = load_frame_data(dataset, dtype=dtype, num_workers=num_workers, memmap=memmap,
+                                      statistics=statistics, histogram_bins=histogram_bins, reader=reader)
+        elif frame_loading in 'ten':
+            dataset = load_frame_data(dataset, np.s_[[0, 1, 2, 3, 4, -5, -4, -3, -2, -1]]
+                                      if dataset.sizes['time'] >= 10 else np.s_[:], dtype=dtype,
+                                      num_workers=num_workers, memmap=memmap, statistics=statistics,
+                                      histogram_bins=histogram_bins, reader=reader)
+    return dataset
+
+
+def load_header(path, verbose=True):
+    """
+    Loads the file header of the measurement at path into a new xarray Dataset.
+
+    path can be anything accepted by NLPReader. The attribute path is only set if the source has a file name.
+    verbose=False suppresses the progress message.
+
+    Raises
+    ------
+    TypeError
+        Raised if the file is not of NLP type.
+
+    Returns
+    -------
+    the dataset holding the header fields as attributes
+
     """
     dataset = xr.Dataset()
-    dataset.attrs['path'] = path
-    with open(path, "rb") as f:
-        print('Loading Header of ' + path)
-        dataset.attrs['file_header'] = f.read(5).decode()
+    with open_reader(path) as reader, stage('header') as timing:
+        if reader.path is not None:
+            dataset.attrs['path'] = reader.path
+        if verbose:
+            print('Loading Header of ' + (reader.path or 'in memory file'))
+        dataset.attrs['file_header'] = bytes(reader.pread(5, 0)).decode(errors='replace')
         if dataset.attrs['file_header'] != 'NLP4\n':
             raise TypeError('The file can not be recognized as an NLP4!')
-    
-        size_of_header = int(f.read(13).decode())
-        header = f.read(size_of_header - f.tell()).decode()
+
+        size_of_header = int(bytes(reader.pread(13, 5)).decode())
+        header = bytes(reader.pread(size_of_header - 18, 18)).decode()
+        timing.bytes_read = size_of_header
         header_by_line = header.split('\n')
     
         dataset.attrs['header_timestamp'] = header_by_line[0]
@@ -56,141 +201,900 @@ def load_NLP(path, frame_loading="all"):
         dataset.attrs.update({s.split(' ')[0]: float(s.split(' ')[1]) for s in
                               list(filter(lambda x: len(x.split(' ')) == 2, header_by_line[4:]))})
         dataset.attrs.pop('', None)
-        f.seek(offset_to_directory)
-        dataset.attrs['directory_position'] = f.tell()
-        block_size = read_int(f, 4)
-        block_content = str(bytearray(f.read(5)))
-        number_of_entries = read_int(f, 4)
-        
-    load_frame_meta_data(dataset)
-            
-    if frame_loading in 'all':
-        load_frame_data(dataset)
-    elif frame_loading in 'ten':
-        if dataset.attrs['number_of_frames'] < 10:
-            load_frame_data(dataset)
-        else:
-            load_frame_data(np.s_[[0, 1, 2, 3, 4, -5, -4, -3, -2, -1]])
-    return dataset   
-def load_frame_meta_data(dataset):
+        dataset.attrs['directory_position'] = offset_to_directory
+
+    return dataset
+
+
+def content_digest(reader, dataset):
+    """
+    Returns the SHA-1 of the file header and the directory, which list every frame of the file.
+    """
+    size_of_header = int(bytes(reader.pread(13, 5)).decode())
+    digest = hashlib.sha1(reader.pread(size_of_header, 0))
+    digest.update(reader.pread(reader.size - dataset.attrs['directory_position'], dataset.attrs['directory_position']))
+    return digest.hexdigest()
+
+
+def select_frames(dataset, frames=None, time=None, grab_time=None):
+    """
+    Returns the indices of the frames of dataset matching all given selections.
+
+    Parameters
+    ----------
+    frames : int, list of int or slice, optional
+        Positional selection of frames, e.g. [0, 5, -1] or np.s_[::10].
+    time : tuple, optional
+        (start, stop) range of the time coordinate including both ends, e.g. ('2019-02-23T18:56', '2019-02-23T19:00').
+        None as start or stop leaves that end open.
+    grab_time : tuple, optional
+        (start, stop) range of the grab_time of the frames including both ends.
+
+    Returns
+    -------
+    numpy.ndarray
+        The selected indices, in the order of frames if given, otherwise in the order of the file.
+
+    """
+    indices = np.arange(dataset.sizes['time'])
+    if frames is not None:
+        indices = np.atleast_1d(indices[frames])
+    for name, limits in (('time', time), ('grab_time', grab_time)):
+        if limits is None:
+            continue
+        values = dataset[name].values[indices]
+        start, stop = limits
+        keep = np.ones(len(indices), dtype=bool)
+        if start is not None:
+            keep &= values >= np.asarray(start, dtype=values.dtype)
+        if stop is not None:
+            keep &= values <= np.asarray(stop, dtype=values.dtype)
+        indices = indices[keep]
+    return indices
+# Fixed size part of the IMG00 block following the text header.
+IMAGE_HEADER = struct.Struct('<IdIIBBB')
+IMAGE_HEADER_FIELDS = ('FrameNumber', 'grab_time', 'width', 'height', 'bits_per_pixel', 'color_component',
+                       'compression_code')
+
+# Per frame fields of the IMG00 block which are needed to locate and decode the frames.
+FRAME_TABLE = ('time', 'CLK', 'FrameNumber', 'grab_time', 'width', 'height', 'bits_per_pixel', 'color_component',
+               'compression_code', 'image_address')
+
+
+def read_frame_header(f, block_start_location):
+    """
+    Reads the header of the IMG00 block at block_start_location.
+
+    Parameters
+    ----------
+    f : NLPReader or any source accepted by NLPReader
+        The NLP file.
+    block_start_location : int
+        Position of the block as listed in the directory.
+
+    Returns
+    -------
+    dict or None
+        The header fields of the frame: the timestamp string as time, CLK, the text header fields as strings and
+        the image header fields (FrameNumber, grab_time, ..., image_address). None if the block is no IMG00 block.
+
+    """
+    with open_reader(f) as reader:
+        block_size, block_content, header_size = struct.unpack('<I5sI', reader.pread(13, block_start_location))
+        if block_content.decode(errors='replace') not in "IMG00":
+            return None
+        # the text header and the fixed size image header following it in one read
+        block = reader.pread(header_size + IMAGE_HEADER.size + 48, block_start_location + 13)
+    header = bytes(block[:header_size]).decode('windows-1252', errors='replace').split('\n')
+
+    fields = {'time': header[0][5:], 'CLK': float(header[1][5:])}
+    for x in header[2:]:
+        if len(x) > 0 and len(x.split(' ')) > 0:
+            fields[x.split(' ')[0][1:].strip()] = x.split(' ')[1].strip()  # [1:] to ignore the star
+    fields.update(zip(IMAGE_HEADER_FIELDS, IMAGE_HEADER.unpack_from(block, header_size)))
+    # 48 reserved bytes precede the image data
+    fields['image_address'] = block_start_location + 13 + header_size + IMAGE_HEADER.size + 48
+    return fields
+
+
+def to_numeric(values):
+    """
+    Converts an array of strings to float64 if all of them parse as numbers, otherwise returns None.
+    """
+    try:
+        return np.asarray(values).astype(np.float64)
+    except ValueError:
+        return None
+
+
+def load_frame_meta_data(dataset, raw_strings=False, collapse_constant=False, reader=None):
     """
     Loads the meta data of frames into the xarray Dataset DataArrays and attributes depending on the occurrence.
 
+    Header fields of the frames which parse as numbers, e.g. GUN_HV '+15000.000000', are stored as float64.
+
+    Parameters
+    ----------
+    raw_strings : bool, optional
+        Additionally keep the strings of the numeric header fields as <field>_raw. The default is False.
+    collapse_constant : bool, optional
+        Store header fields which have the same value for every frame as attributes instead of DataArrays.
+        Fields already present as attributes of the file header stay DataArrays. The default is False.
+    reader : NLPReader, optional
+        Reader of the file. The default is None which opens dataset.attrs['path'].
+
     Returns
     -------
     None.
 
     """
-    with open(dataset.attrs['path'], "rb") as f:
-        f.seek(dataset.attrs['directory_position'])
-        block_size = read_int(f, 4)
-        block_content = str(bytearray(f.read(5)))
-        number_of_entries = read_int(f, 4)
+    with open_reader(dataset.attrs['path'] if reader is None else reader) as reader:
+        directory = read_directory(reader, dataset.attrs['directory_position'])
+        with stage('metadata') as timing:
+            meta_data = defaultdict(dict)
+            for i in np.flatnonzero(directory['content_code'] == 1).tolist():
+                block_start_location = int(directory['block_start_location'][i])
+                frame_header = read_frame_header(reader, block_start_location)
+                if frame_header is None:
+                    continue
+                timing.bytes_read += frame_header['image_address'] - block_start_location
+                for name, value in frame_header.items():
+                    meta_data[name].update({i: value})
 
-        directory = defaultdict(list)
+            for key, value in meta_data.items():
+                if len(value) == len(meta_data['time']):
+                    values = np.asarray([value[x] for x in value])
+                    if key == 'time':
+                        values = parse_timestamps(values)
+                    elif values.dtype.kind == 'U':
+                        numbers = to_numeric(values)
+                        if numbers is not None:
+                            if raw_strings:
+                                dataset[key.strip() + '_raw'] = (['time'], values)
+                            values = numbers
+                    if (collapse_constant and key not in FRAME_TABLE and key.strip() not in dataset.attrs
+                            and len(values) > 0 and (values == values[0]).all()):
+                        dataset.attrs[key.strip()] = values[0].item()
+                        continue
+                    dataset[key.strip()] = (['time'], values)
+                else:
+                    print(
+                        'Could not add {} to DataArray due to missing values. Added string representation to attributes instead!'.format(
+                            key))
+                    dataset.attrs[key.strip()] = str(value)
 
-        for i in range(0, number_of_entries):
-            directory['frame_number'].append(read_int(f, 4))
-            directory['content_code'].append(read_int(f, 1))
-            directory['block_start_location'].append(read_int(f, 4))
-            f.seek(26, 1)
-        meta_data = defaultdict(dict)
-        for i, val in enumerate(directory['content_code']):
-            if val != 1:
-                continue
-            f.seek(directory['block_start_location'][i])
+            if 'grab_time' in dataset:
+                dataset['time'] = (['time'], refine_time(dataset.time.values, dataset.grab_time.values))
+            dataset.coords['time'] = dataset.time
 
-            block_size = read_int(f, 4)
 
-            block_content = bytearray(f.read(5)).decode(errors='replace')
-            if block_content not in "IMG00":
-                continue
+MONTHS = {month: number for number, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+
+
+def parse_timestamps(timestamps):
+    """
+    Parses the timestamps of the frame headers, e.g. 'Sat Feb 23 18:56:58 2019'.
+
+    Frames recorded within the same second share their timestamp, so every distinct timestamp is parsed once.
 
-            header_size = read_int(f, 4)
-            header = bytearray(f.read(header_size)).decode('windows-1252', errors='replace').split(
-                '\n')
+    Parameters
+    ----------
+    timestamps : array_like of str
+        The timestamps in the format '%a %b %d %H:%M:%S %Y'.
 
-            meta_data['time'].update({i: datetime.strptime(header[0][5:], '%a %b %d %H:%M:%S %Y')})
-            meta_data['CLK'].update({i: float(header[1][5:])})
-            for x in header[2:]:
-                if len(x) > 0 and len(x.split(' ')) > 0:
-                    meta_data[x.split(' ')[0][1:].strip()].update(
-                        {i: x.split(' ')[1].strip()})  # [1:] to ignore the star
+    Returns
+    -------
+    numpy.ndarray
+        The timestamps as datetime64[ns].
 
-            meta_data['FrameNumber'].update({i: read_int(f, 4)})
+    """
+    unique, inverse = np.unique(np.asarray(timestamps, dtype=str), return_inverse=True)
+    iso = []
+    for timestamp in unique.tolist():
+        try:
+            weekday, month, day, clock, year = timestamp.split()
+            iso.append('{}-{:02d}-{:02d}T{}'.format(year, MONTHS[month], int(day), clock))
+        except (ValueError, KeyError):
+            iso.append(datetime.strptime(timestamp, '%a %b %d %H:%M:%S %Y').isoformat())
+    return np.array(iso, dtype='datetime64[ns]')[inverse.reshape(-1)]
 
-            meta_data['grab_time'].update({i: struct.unpack('d', f.read(8))[0]})
-            meta_data['width'].update({i: read_int(f, 4)})
-            meta_data['height'].update({i: read_int(f, 4)})
 
-            meta_data['bits_per_pixel'].update({i: read_int(f, 1)})
-            meta_data['color_component'].update({i: read_int(f, 1)})
-            meta_data['compression_code'].update({i: read_int(f, 1)})
-            f.seek(48, 1)
-            meta_data['image_address'].update({i: f.tell()})
+def refine_time(time, grab_time):
+    """
+    Adds the sub-second part of the frame times from grab_time to the second resolution time of the frame headers.
 
-    for key, value in meta_data.items():
-        if len(value) == len(meta_data['time']):
-            dataset[key.strip()] = (['time'], np.asarray([value[x] for x in value]))
-        else:
-            print(
-                'Could not add {} to DataArray due to missing values. Added string representation to attributes instead!'.format(
-                    key))
-            dataset.attrs[key.strip()] = str(value)
+    grab_time counts seconds on a clock of its own, the offset to the wall clock is chosen as the smallest one
+    consistent with the timestamps of all frames. time is returned unchanged if grab_time is not monotonic or does not
+    agree with time to within a second.
 
-    dataset.coords['time'] = dataset.time
+    Returns
+    -------
+    numpy.ndarray
+        The frame times as datetime64[ns].
+
+    """
+    if len(time) == 0 or not np.isfinite(grab_time).all() or (np.diff(grab_time) < 0).any():
+        return time
+    grab_time = np.round(grab_time * 1e9).astype(np.int64).astype('timedelta64[ns]')
+    refined = (time - grab_time).max() + grab_time
+    if ((refined < time) | (refined >= time + np.timedelta64(1, 's'))).any():
+        return time
+    return refined
+
+
+def frame_dtype(bits_per_pixel):
+    """
+    Returns the native little-endian numpy dtype for frames with bits_per_pixel bits.
+    """
+    return np.dtype('<u1') if bits_per_pixel <= 8 else np.dtype('<u2')
 
 
-def load_frame_data(dataset, data_slice=np.s_[:]):
+def read_image_block(f, image_address, out=None):
+    """
+    Reads the still encoded image data block of a frame at image_address from an open NLP file or NLPReader.
+
+    If out is given, the block is read directly into the memory of the array out, which is returned.
+    This only makes sense for uncompressed frames of the native dtype.
+    """
+    with open_reader(f) as reader, stage('io') as timing:
+        size_of_image, = struct.unpack('<I', reader.pread(4, image_address))
+        timing.bytes_read = 4 + size_of_image
+        if out is None:
+            return reader.pread(size_of_image, image_address + 4)
+        reader.readinto(memoryview(out).cast('B')[:size_of_image], image_address + 4)
+    return out
+
+
+def memmap_frames(dataset, reader=None):
+    """
+    Maps the uncompressed frames of dataset into memory without reading them.
+
+    This works if all frames are uncompressed, share their size and bit depth and follow each other with
+    a constant distance in the file, as is the case for measurements acquired without compression.
+
+    Parameters
+    ----------
+    reader : NLPReader, optional
+        Reader of the file, frames of in memory sources are viewed without a copy.
+        The default is None which maps dataset.attrs['path'].
+
+    Returns
+    -------
+    numpy.ndarray or None
+        Read only array of shape (time, height, width) backed by a memory map of the file,
+        None if the frames can not be mapped.
+
+    """
+    if dataset.sizes['time'] == 0 or (dataset.compression_code.values == 3).any():
+        return None
+    if any(len(np.unique(dataset[name].values)) != 1 for name in ('bits_per_pixel', 'width', 'height')):
+        return None
+    image_address = dataset.image_address.values.astype(np.int64)
+    stride = np.unique(np.diff(image_address))
+    if len(stride) > 1:
+        return None
+
+    dtype = frame_dtype(int(dataset.bits_per_pixel[0]))
+    height, width = int(dataset.height[0]), int(dataset.width[0])
+    if reader is None:
+        mapped = np.memmap(dataset.attrs['path'], dtype=np.uint8, mode='r')
+    else:
+        mapped = reader.memmap()
+    if mapped is None:
+        return None
+    size_of_image = mapped[image_address[:, None] + np.arange(4)].view('<u4').ravel()
+    if (size_of_image != height * width * dtype.itemsize).any():
+        return None
+    return np.ndarray((len(image_address), height, width), dtype=dtype, buffer=mapped, offset=image_address[0] + 4,
+                      strides=(stride[0] if len(stride) else 0, width * dtype.itemsize, dtype.itemsize))
+
+
+def decode_frame(binary_image, bits_per_pixel, compression_code, height, width, out=None):
+    """
+    Decodes the image data block of a single frame.
+
+    Parameters
+    ----------
+    binary_image : bytes
+        The image data block as returned by read_image_block.
+    bits_per_pixel : int
+        8 or 16 bit image data.
+    compression_code : int
+        3 for zlib compressed delta encoded data, anything else for raw data.
+    height, width : int
+        Size of the frame.
+    out : numpy.ndarray, optional
+        Array of shape (height, width) the frame is written to. The default is None which allocates a new array.
+
+    Returns
+    -------
+    numpy.ndarray
+        The frame with shape (height, width), in the native dtype of the frame (see frame_dtype) unless out is given.
+
+    """
+    dtype = frame_dtype(bits_per_pixel)
+    if compression_code == 3:
+        # delta encoded, the unsigned cumulative sum wraps around exactly like the encoder did
+        with stage('zlib') as timing:
+            deltas = np.frombuffer(zlib.decompress(binary_image), dtype=dtype)
+            timing.bytes_decompressed = deltas.nbytes
+        with stage('delta'):
+            if out is not None and out.dtype == dtype and out.flags.c_contiguous:
+                np.cumsum(deltas, dtype=dtype, out=out.reshape(-1))
+                return out
+            frame = deltas.cumsum(dtype=dtype).reshape((height, width))
+    else:
+        frame = np.frombuffer(binary_image, dtype=dtype).reshape((height, width))
+    if out is None:
+        return frame
+    out[...] = frame
+    return out
+
+
+def decode_deltas(buffers, bits_per_pixel, out):
+    """
+    Reconstructs many delta encoded frames in a single vectorized pass.
+
+    The decompressed deltas of all frames are copied into out and integrated in place with one cumulative sum
+    along the pixels. The sum runs in the unsigned native dtype, so it wraps around modulo 2 ** 8 or 2 ** 16 exactly
+    like the encoder, for 8 and 16 bit data alike. Batching saves the per frame overhead, which dominates for small
+    frames.
+
+    Parameters
+    ----------
+    buffers : sequence of bytes
+        The zlib decompressed image data of the frames, e.g. zlib.decompress(read_image_block(...)).
+    bits_per_pixel : int
+        8 or 16 bit image data.
+    out : numpy.ndarray
+        C-contiguous array of the native dtype (see frame_dtype) with one frame per buffer along the first axis,
+        e.g. of shape (len(buffers), height, width).
+
+    Raises
+    ------
+    ValueError
+        Raised if out has another dtype or is not C-contiguous.
+
+    Returns
+    -------
+    numpy.ndarray
+        out
+
+    """
+    dtype = frame_dtype(bits_per_pixel)
+    if out.dtype != dtype or not out.flags.c_contiguous:
+        raise ValueError('out needs to be a C-contiguous {} array!'.format(dtype))
+    rows = out.reshape(len(buffers), -1)
+    for row, buffer in zip(rows, buffers):
+        row[:] = np.frombuffer(buffer, dtype=dtype)
+    with stage('delta'):
+        np.cumsum(rows, axis=1, dtype=dtype, out=rows)
+    return out
+
+
+# Compressed frames of at least this many bytes are decoded with stream_frame.
+STREAM_FRAME_BYTES = 1 << 22
+
+
+def stream_frame(f, image_address, bits_per_pixel, out, chunk_size=1 << 16):
+    """
+    Reads, decompresses and integrates a zlib compressed delta encoded frame in small chunks straight into out.
+
+    Compressed input and decompressed output are handled chunk_size bytes at a time. Each decompressed chunk is
+    written to its place in out and integrated there, carrying the last value of the previous chunk, so the memory
+    needed besides out is a few chunks regardless of the frame size. As zlib and the cumulative sum run on data in
+    the CPU cache, this is about as fast as decode_frame for large frames.
+
+    Parameters
+    ----------
+    f : NLPReader or any source accepted by NLPReader
+        The NLP file.
+    image_address : int
+        Position of the image data block of the frame in the file.
+    bits_per_pixel : int
+        8 or 16 bit image data.
+    out : numpy.ndarray
+        C-contiguous array of the native dtype (see frame_dtype) and the size of the frame.
+    chunk_size : int, optional
+        Size of the compressed and decompressed chunks in bytes. The default is 64 kB.
+
+    Raises
+    ------
+    ValueError
+        Raised if out has another dtype, is not C-contiguous or the frame does not fill out.
+
+    Returns
+    -------
+    numpy.ndarray
+        out
+
+    """
+    dtype = frame_dtype(bits_per_pixel)
+    if out.dtype != dtype or not out.flags.c_contiguous:
+        raise ValueError('out needs to be a C-contiguous {} array!'.format(dtype))
+    pixels = out.reshape(-1)
+    target = pixels.view(np.uint8)
+    decompressor = zlib.decompressobj()
+    written = integrated = 0
+    # the chunks are timed per stage and recorded once per frame, only while instrumented
+    stats = current()
+    clock = perf_counter if stats is not None else float
+    seconds = {'io': 0., 'zlib': 0., 'delta': 0.}
+
+    def integrate(data):
+        nonlocal written, integrated
+        if written + len(data) > target.size:
+            raise ValueError('The frame at {} is larger than out!'.format(image_address))
+        target[written:written + len(data)] = np.frombuffer(data, dtype=np.uint8)
+        written += len(data)
+        # the unsigned sum wraps like the encoder, a 16 bit pixel split between chunks waits for the next one
+        complete = written // dtype.itemsize
+        if complete > integrated:
+            start = clock()
+            segment = pixels[integrated:complete]
+            if integrated > 0:
+                np.add(segment[:1], pixels[integrated - 1], out=segment[:1])
+            np.cumsum(segment, dtype=dtype, out=segment)
+            integrated = complete
+            seconds['delta'] += clock() - start
+
+    def decompress(data):
+        start = clock()
+        data = decompressor.decompress(data, chunk_size) if data is not None else decompressor.flush()
+        seconds['zlib'] += clock() - start
+        integrate(data)
+
+    with open_reader(f) as reader:
+        start = clock()
+        size_of_image, = struct.unpack('<I', reader.pread(4, image_address))
+        seconds['io'] += clock() - start
+        for offset in range(0, size_of_image, chunk_size):
+            start = clock()
+            data = reader.pread(min(chunk_size, size_of_image - offset), image_address + 4 + offset)
+            seconds['io'] += clock() - start
+            while data:
+                decompress(data)
+                data = decompressor.unconsumed_tail
+        decompress(None)
+    if stats is not None:
+        stats.record('io', seconds['io'], bytes_read=4 + size_of_image)
+        stats.record('zlib', seconds['zlib'], bytes_decompressed=written)
+        stats.record('delta', seconds['delta'])
+    if written != target.size:
+        raise ValueError('The frame at {} does not fill out!'.format(image_address))
+    return out
+
+
+def read_frame(f, image_address, bits_per_pixel, compression_code, height, width):
+    """
+    Reads and decodes a single frame from an open NLP file.
+
+    Parameters
+    ----------
+    f : file object or NLPReader
+        The NLP file opened in binary mode.
+    image_address : int
+        Position of the image data block of the frame in the file.
+    bits_per_pixel : int
+        8 or 16 bit image data.
+    compression_code : int
+        3 for zlib compressed delta encoded data, anything else for raw data.
+    height, width : int
+        Size of the frame.
+
+    Returns
+    -------
+    numpy.ndarray
+        The frame with shape (height, width) in the native dtype of the frame, see frame_dtype.
+        Read only if frame_cache is enabled.
+
+    """
+    with open_reader(f) as reader:
+        if not frame_cache.max_bytes or reader.identity is None:
+            return decode_frame(read_image_block(reader, image_address), bits_per_pixel, compression_code, height,
+                                width)
+        key = (reader.identity, int(image_address))
+        frame = frame_cache.get(key)
+        if frame is None:
+            frame = decode_frame(read_image_block(reader, image_address), bits_per_pixel, compression_code, height,
+                                 width)
+            frame_cache.put(key, frame)
+    return frame
+
+
+def load_frame_data(dataset, data_slice=np.s_[:], dtype=None, num_workers=1, memmap=False,
+                    statistics=('min', 'max'), histogram_bins=None, reader=None, progress=True):
     """
     Load the frames into the Dataset dataset
 
     Parameters
     ----------
     data_slice : numpy slice, optional
-        Directly determines the frames which are loaded. The default is np.s_[:] which loads all frames.
+        Directly determines the frames which are loaded, e.g. a slice or the indices returned by select_frames.
+        The default is np.s_[:] which loads all frames.
+    dtype : numpy dtype, optional
+        dtype of the intensity. The default is None which keeps the native uint8 or uint16 of the file,
+        e.g. np.float32 promotes the frames while loading.
+    num_workers : int, optional
+        Number of threads reading and decoding the frames directly into the intensity array. The default is 1
+        which loads the frames in the calling thread.
+    memmap : bool, optional
+        If True and the frames are stored uncompressed (see memmap_frames), the intensity is a view on a memory
+        map of the file instead of being read. No statistics are computed in that case.
+        Ignored if dtype differs from the native dtype. The default is False.
+    statistics : tuple of str, optional
+        Per frame statistics computed right after decoding each frame and stored as the variables
+        <statistic>_counts, out of 'min', 'max', 'mean' and 'sum'. The default is ('min', 'max').
+    histogram_bins : int, optional
+        Number of equally sized bins over the full range of the bit depth for a per frame histogram stored as
+        the variable histogram along the dimension counts. The default is None which computes no histogram.
+    reader : NLPReader, optional
+        Reader of the file. The default is None which opens dataset.attrs['path'].
+    progress : bool, optional
+        Show a progress bar. The default is True.
 
     Returns
     -------
-    None.
+    xarray.Dataset
+        The dataset restricted to the frames selected by data_slice, holding the intensity of these frames.
+        If all frames are selected, this is dataset itself.
 
     """
+    frames = np.atleast_1d(np.arange(dataset.sizes['time'])[data_slice])
+    if not np.array_equal(frames, np.arange(dataset.sizes['time'])):
+        dataset = dataset.isel(time=frames)
+
     if len(dataset.image_address) == 0:
-        return
+        return dataset
 
     height = dataset.height.max().data
     width = dataset.width.max().data
-    tdata = np.zeros((dataset.image_address.shape[0], height, width))
+    if dtype is None:
+        dtype = frame_dtype(int(dataset.bits_per_pixel.max()))
 
-    dataset['max_counts'] = (['time'], np.zeros(dataset.image_address.shape[0]))
-    dataset['min_counts'] = (['time'], np.zeros(dataset.image_address.shape[0]))
+    if memmap and dtype == frame_dtype(int(dataset.bits_per_pixel.max())):
+        mapped = memmap_frames(dataset, reader)
+        if mapped is not None:
+            dataset['intensity'] = (['time', 'y', 'x'], mapped)
+            return dataset
 
-    with open(dataset.attrs['path'], "rb") as f:
+    tdata = np.zeros((dataset.image_address.shape[0], height, width), dtype=dtype)
 
-        for i in tqdm(np.arange(dataset.image_address.shape[0])[data_slice], desc="Loading image data..."):
+    number_of_frames = dataset.image_address.shape[0]
+    sum_dtype = np.uint64 if np.issubdtype(dtype, np.integer) else np.float64
+    counts = {'min': np.zeros(number_of_frames, dtype=dtype), 'max': np.zeros(number_of_frames, dtype=dtype),
+              'mean': np.zeros(number_of_frames), 'sum': np.zeros(number_of_frames, dtype=sum_dtype)}
+    counts = {statistic: counts[statistic] for statistic in statistics}
+    histogram_range = (0, 2 ** int(dataset.bits_per_pixel.max()))
+    histogram = None
+    if histogram_bins is not None:
+        histogram = np.zeros((number_of_frames, histogram_bins), dtype=np.int64)
 
-            f.seek(dataset.image_address[i].data)
-            size_of_image = read_int(f, 4)
-            binary_image = f.read(size_of_image)
+    image_address = dataset.image_address.values
+    bits_per_pixel = dataset.bits_per_pixel.values
+    compression_code = dataset.compression_code.values
 
-            if dataset.bits_per_pixel[i] == 8:
-                if dataset.compression_code[i] == 3:
-                    tdata[i, :, :] = np.frombuffer(zlib.decompress(binary_image), dtype='<i1').cumsum().astype(
-                        np.uint8).astype(int).reshape((height, width))
-                else:
-                    tdata[i, :, :] = np.frombuffer(binary_image, dtype='<u1').astype(
-                        np.uint8).astype(int).reshape((height, width))
+    def load(batch):
+        deltas = []
+        for i in batch:
+            native = tdata.dtype == frame_dtype(bits_per_pixel[i])
+            # only frames in their native dtype are shared with the cache
+            if cache and native:
+                frame = frame_cache.get((reader.identity, int(image_address[i])))
+                if frame is not None:
+                    tdata[i] = frame
+                    update_counts(i)
+                    continue
+            if compression_code[i] != 3 and native:
+                # raw frames are read straight into the intensity array
+                read_image_block(reader, image_address[i], out=tdata[i])
+            elif compression_code[i] == 3 and native and len(batch) > 1:
+                # integrated together with the other frames of the batch
+                binary_image = read_image_block(reader, image_address[i])
+                with stage('zlib') as timing:
+                    deltas.append((i, zlib.decompress(binary_image)))
+                    timing.bytes_decompressed = len(deltas[-1][1])
+                continue
+            elif compression_code[i] == 3 and native and tdata[i].nbytes >= STREAM_FRAME_BYTES:
+                # large frames are decompressed in small chunks instead of as a whole
+                stream_frame(reader, image_address[i], bits_per_pixel[i], tdata[i])
+            else:
+                decode_frame(read_image_block(reader, image_address[i]), bits_per_pixel[i], compression_code[i],
+                             height, width, out=tdata[i])
+            finish(i)
+        # one decode_deltas call for each run of consecutive frames
+        runs = np.split(np.arange(len(deltas)), np.flatnonzero(np.diff([i for i, _ in deltas]) != 1) + 1)
+        for run in runs if deltas else []:
+            first, last = deltas[run[0]][0], deltas[run[-1]][0]
+            decode_deltas([deltas[n][1] for n in run], bits_per_pixel[first], out=tdata[first:last + 1])
+            for n in run:
+                finish(deltas[n][0])
+
+    def finish(i):
+        if cache and tdata.dtype == frame_dtype(bits_per_pixel[i]):
+            frame_cache.put((reader.identity, int(image_address[i])), tdata[i].copy())
+        update_counts(i)
+
+    def update_counts(i):
+        if not counts and histogram_bins is None:
+            return
+        # computed while the frame is still in the cache of the decoding thread
+        frame = tdata[i]
+        with stage('statistics'):
+            if 'min' in counts:
+                counts['min'][i] = frame.min()
+            if 'max' in counts:
+                counts['max'][i] = frame.max()
+            if 'sum' in counts or 'mean' in counts:
+                total = frame.sum(dtype=sum_dtype)
+                if 'sum' in counts:
+                    counts['sum'][i] = total
+                if 'mean' in counts:
+                    counts['mean'][i] = total / frame.size
+            if histogram_bins is not None:
+                histogram[i] = np.histogram(frame, bins=histogram_bins, range=histogram_range)[0]
+
+    from tqdm import tqdm
+    with open_reader(dataset.attrs['path'] if reader is None else reader) as reader:
+        cache = frame_cache.max_bytes > 0 and reader.identity is not None
+        # frames up to 16 kB are decoded in batches of about 1 MB, larger ones gain nothing from decode_deltas
+        frames_per_batch = (1 << 20) // tdata[0].nbytes if tdata[0].nbytes <= 1 << 14 else 1
+        batches = [range(start, min(start + frames_per_batch, len(image_address)))
+                   for start in range(0, len(image_address), frames_per_batch)]
+        bar = tqdm(total=len(image_address), desc="Loading image data...", disable=not progress)
+        if num_workers <= 1:
+            for batch in batches:
+                load(batch)
+                bar.update(len(batch))
+        else:
+            # the workers read with positional reads of the shared reader, so reading and decoding run in parallel
+            with ThreadPoolExecutor(num_workers) as executor:
+                for batch, _ in zip(batches, executor.map(load, batches)):
+                    bar.update(len(batch))
+        bar.close()
+
+    with stage('assembly'):
+        dataset['intensity'] = (['time', 'y', 'x'], tdata)
+        store_statistics(dataset, counts, histogram, histogram_range)
+    return dataset
+
+
+def store_statistics(dataset, counts, histogram, histogram_range):
+    """
+    Adds the per frame statistics computed by load_frame_data to dataset.
+
+    Parameters
+    ----------
+    counts : dict
+        Per frame values of the statistics 'min', 'max', 'mean' and 'sum', stored as <statistic>_counts.
+    histogram : numpy.ndarray or None
+        Per frame histograms of shape (time, bins) over histogram_range.
+    histogram_range : tuple
+        Range of the histogram bins, (0, 2 ** bits_per_pixel).
+
+    """
+    for statistic, values in counts.items():
+        dataset[statistic + '_counts'] = (['time'], values)
+    if histogram is not None:
+        dataset['histogram'] = (['time', 'counts'], histogram)
+        dataset.coords['counts'] = np.linspace(*histogram_range, histogram.shape[1], endpoint=False)
+    if 'max' in counts:
+        dataset.attrs['max_counts'] = counts['max'].max()
+    if 'min' in counts:
+        dataset.attrs['min_counts'] = counts['min'].min()
 
+
+def stack_statistics(intensity, statistics, histogram_bins, histogram_range):
+    """
+    Computes the per frame statistics of load_frame_data for a whole stack of frames, e.g. a mapped stack cache.
+
+    Returns
+    -------
+    counts : dict
+        Per frame values of the statistics, see store_statistics.
+    histogram : numpy.ndarray or None
+        Per frame histograms, None if histogram_bins is None.
+
+    """
+    sum_dtype = np.uint64 if np.issubdtype(intensity.dtype, np.integer) else np.float64
+    counts = {}
+    for statistic in statistics:
+        if statistic == 'min':
+            counts['min'] = intensity.min(axis=(1, 2))
+        elif statistic == 'max':
+            counts['max'] = intensity.max(axis=(1, 2))
+        elif statistic == 'sum':
+            counts['sum'] = intensity.sum(axis=(1, 2), dtype=sum_dtype)
+        elif statistic == 'mean':
+            counts['mean'] = intensity.sum(axis=(1, 2), dtype=sum_dtype) / intensity[0].size
+    histogram = None
+    if histogram_bins is not None:
+        histogram = np.asarray([np.histogram(frame, bins=histogram_bins, range=histogram_range)[0]
+                                for frame in intensity], dtype=np.int64).reshape(len(intensity), histogram_bins)
+    return counts, histogram
+
+
+def iter_frames(path, selection=None, readahead=False, index_cache=None):
+    """
+    Iterates over the frames of a measurement one at a time, holding only a single decoded frame in memory.
+
+    Parameters
+    ----------
+    path : str
+        Path to the measurement file, or anything else accepted by NLPReader.
+    selection : int, list of int or slice, optional
+        Frames to iterate over, see the frames argument of select_frames. The default is None which yields all frames.
+    readahead : bool, optional
+        Read the next frames from the file on a background thread while the current frame is processed.
+        The default is False.
+    index_cache : bool or str, optional
+        See load_NLP.
+
+    Yields
+    ------
+    index : int
+        Position of the frame in the measurement.
+    meta_data : dict
+        The per frame metadata, e.g. time, grab_time and the lens values of the frame header.
+    frame : numpy.ndarray
+        The frame in its native dtype. The same array is reused for every frame, copy it to keep it.
+
+    """
+    with open_reader(path) as reader:
+        yield from _iter_frames(reader, selection, readahead, index_cache)
+
+
+def _iter_frames(reader, selection, readahead, index_cache):
+    dataset = load_NLP(reader, frame_loading='none', index_cache=index_cache)
+    indices = select_frames(dataset, selection)
+    if len(indices) == 0:
+        return
+    columns = {name: variable.values for name, variable in dataset.variables.items()}
+    image_address = columns['image_address']
+    bits_per_pixel = columns['bits_per_pixel']
+    compression_code = columns['compression_code']
+    height, width = int(columns['height'].max()), int(columns['width'].max())
+    frame = np.empty((height, width), dtype=frame_dtype(int(bits_per_pixel.max())))
+    # without read ahead, large compressed frames are decompressed in small chunks, see stream_frame
+    stream = (compression_code == 3) & (frame_dtype(int(bits_per_pixel.max())) == np.asarray(
+        [frame_dtype(bits) for bits in bits_per_pixel])) & (frame.nbytes >= STREAM_FRAME_BYTES) & (not readahead)
+
+    def blocks():
+        for i in indices:
+            yield None if stream[i] else read_image_block(reader, image_address[i])
+
+    source = _read_ahead(blocks()) if readahead else blocks()
+    try:
+        for i, binary_image in zip(indices, source):
+            if stream[i]:
+                stream_frame(reader, image_address[i], bits_per_pixel[i], frame)
             else:
-                if dataset.compression_code[i] == 3:
-                    tdata[i, :, :] = np.frombuffer(zlib.decompress(binary_image), dtype='<i2').cumsum().reshape((height, width))
-                else:
-                    tdata[i, :, :] = np.frombuffer(binary_image, dtype='<u2').reshape((height, width))
+                decode_frame(binary_image, bits_per_pixel[i], compression_code[i], height, width, out=frame)
+            yield int(i), {name: column[i] for name, column in columns.items()}, frame
+    finally:
+        source.close()
+
+
+def _read_ahead(iterable, depth=2):
+    """
+    Runs iterable on a background thread, keeping up to depth items ready, and yields its items.
+    """
+    items = queue.Queue(depth)
+    stop = threading.Event()
 
-            dataset.max_counts[i] = tdata[i, :, :].max()
-            dataset.min_counts[i] = tdata[i, :, :].min()
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-    dataset['intensity'] = (['time', 'y', 'x'], tdata)
-    dataset.attrs['max_counts'] = dataset.max_counts.max().data
-    dataset.attrs['min_counts'] = dataset.min_counts.min().data 
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as error:
+            put((False, error))
+        finally:
+            iterable.close()
 
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            has_item, item = items.get()
+            if not has_item:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def follow_NLP(path, interval=1., timeout=None, start=0):
+    """
+    Follows a measurement which is still being written and yields every frame as soon as it is complete in the file.
+
+    The IMG00 blocks are walked from the end of the last processed block, so every poll only reads the headers and
+    image data of the frames appended since. The generator returns once the directory announced in the file header
+    has been written, i.e. the acquisition has finished, or after timeout seconds without a new frame. A file
+    header which is not written yet and a directory block the header does not point to yet are looked at again
+    on the next poll.
+
+    Parameters
+    ----------
+    path : str
+        Path to the measurement file.
+    interval : float, optional
+        Seconds to wait before looking for new frames again. The default is 1.
+    timeout : float, optional
+        Seconds without a new frame after which the generator returns. The default is None which waits until the
+        measurement is finished.
+    start : int, optional
+        Index of the first frame to yield, earlier frames are skipped without decoding them. The default is 0.
+
+    Yields
+    ------
+    index : int
+        Position of the frame in the measurement.
+    meta_data : dict
+        The header fields of the frame, see read_frame_header, with the time parsed and numeric fields as float.
+    frame : numpy.ndarray
+        The frame in its native dtype.
+
+    Examples
+    --------
+    >>> for index, meta_data, frame in follow_NLP('running.nlp', interval=0.5):
+    ...     print(index, meta_data['STV'], frame.mean())
+
+    """
+    position = None
+    index = 0
+    last_frame = monotonic()
+    while True:
+        with open_reader(path) as reader:
+            size = reader.size
+            if position is None and size >= 18:
+                try:
+                    position = int(bytes(reader.pread(13, 5)).decode())
+                except ValueError:
+                    # the header is not written yet
+                    pass
+            while position is not None and position + 13 <= size:
+                block_size, block_content = struct.unpack('<I5s', reader.pread(9, position))
+                if block_size < 13 or position + block_size > size:
+                    # the block is not completely written yet
+                    break
+                if block_content == b'DIR00':
+                    try:
+                        directory_position = load_header(reader, verbose=False).attrs['directory_position']
+                    except (TypeError, ValueError, IndexError):
+                        directory_position = None
+                    if position == directory_position:
+                        return
+                    # the header may be updated after the directory, it is read again on the next poll
+                    break
+                if block_content == b'IMG00':
+                    if index >= start:
+                        fields = read_frame_header(reader, position)
+                        frame = read_frame(reader, fields['image_address'], fields['bits_per_pixel'],
+                                           fields['compression_code'], fields['height'], fields['width'])
+                        fields['time'] = parse_timestamps(np.asarray([fields['time']]))[0]
+                        for name, value in fields.items():
+                            if isinstance(value, str):
+                                number = to_numeric([value])
+                                fields[name] = value if number is None else number[0]
+                        yield index, fields, frame
+                    index += 1
+                    last_frame = monotonic()
+                position += block_size
+        if timeout is not None and monotonic() - last_frame > timeout:
+            return
+        sleep(interval)
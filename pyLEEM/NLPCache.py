@@ -0,0 +1,281 @@
+import numpy as np
+import xarray as xr
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+# Bumped whenever the content of the index changes so old sidecar files are rebuilt.
+INDEX_CACHE_VERSION = 3
+
+
+def cache_file(path, cache, suffix):
+    """
+    Returns where the cache file with suffix for the NLP file at path is stored.
+
+    Parameters
+    ----------
+    path : str
+        Path to the measurement file.
+    cache : bool or str
+        True places the cache file next to the measurement file, a str is a directory collecting the cache files.
+    suffix : str
+        File ending of the cache file, e.g. '.idx.npz'.
+
+    """
+    if cache is True:
+        return path + suffix
+    os.makedirs(cache, exist_ok=True)
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    return os.path.join(cache, digest + '_' + os.path.basename(path) + suffix)
+
+
+def source_key(path):
+    """
+    Returns the key identifying the current state of the file at path: absolute path, size and mtime.
+    """
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def write_atomic(target, save, mode='wb'):
+    """
+    Writes a file by calling save with a temporary file next to target and renaming it to target.
+
+    Every writer uses its own temporary file, so processes caching the same measurement at once never publish a file
+    another one is still writing.
+
+    Raises
+    ------
+    OSError
+        Raised if the file can not be written, the temporary file is removed.
+
+    """
+    # a random name instead of tempfile.mkstemp keeps the permissions of the umask for caches shared between users
+    temporary = '{}.{}.tmp'.format(target, uuid.uuid4().hex)
+    try:
+        with open(temporary, mode.replace('w', 'x')) as f:
+            save(f)
+        os.replace(temporary, target)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def write_index_cache(dataset, cache, options=()):
+    """
+    Stores the header attributes and the per frame metadata of dataset in a sidecar index file.
+
+    Parameters
+    ----------
+    dataset : xarray.Dataset
+        Dataset as returned by load_NLP(path, frame_loading='none').
+    cache : bool or str
+        See cache_file.
+    options : list, optional
+        JSON serializable loading options the dataset was created with, the index is only reused for the same options.
+
+    """
+    path = dataset.attrs['path']
+    arrays = {'var:' + name: variable.values for name, variable in dataset.variables.items()}
+    if any(array.dtype.hasobject for array in arrays.values()):
+        return
+    attrs = {key: value.item() if isinstance(value, np.generic) else value for key, value in dataset.attrs.items()
+             if key != 'path'}
+    index = cache_file(path, cache, '.idx.npz')
+    try:
+        key = json.dumps([INDEX_CACHE_VERSION, list(options)] + source_key(path))
+        write_atomic(index, lambda f: np.savez(f, key=key, attrs=json.dumps(attrs), **arrays))
+    except OSError:
+        # a read only data directory only costs the speedup
+        pass
+
+
+def read_index_cache(path, cache, options=()):
+    """
+    Loads the dataset stored by write_index_cache for the file at path.
+
+    Returns
+    -------
+    xarray.Dataset or None
+        None if there is no index or if it was written for another version of the file or other options.
+
+    """
+    index = cache_file(path, cache, '.idx.npz')
+    if not os.path.exists(index):
+        return None
+    try:
+        with np.load(index) as stored:
+            if json.loads(str(stored['key'])) != [INDEX_CACHE_VERSION, list(options)] + source_key(path):
+                return None
+            dataset = xr.Dataset(attrs={'path': path})
+            dataset.attrs.update(json.loads(str(stored['attrs'])))
+            for name in stored.files:
+                if name.startswith('var:'):
+                    dataset[name[4:]] = (['time'], stored[name])
+    except (OSError, ValueError, KeyError):
+        return None
+    dataset.coords['time'] = dataset.time
+    return dataset
+
+
+def write_stack_cache(path, intensity, cache, digest='', statistics=None):
+    """
+    Stores the decoded frames of the NLP file at path as .npy file, see read_stack_cache.
+
+    Parameters
+    ----------
+    path : str
+        Path to the measurement file.
+    intensity : numpy.ndarray
+        All frames of the measurement in their native dtype.
+    cache : bool or str
+        See cache_file.
+    digest : str, optional
+        Checksum of the file content, e.g. of header and directory, stored in addition to size and mtime.
+    statistics : dict, optional
+        Per frame statistics stored next to the frames, e.g. {'max_counts': ...}. The default is None.
+
+    """
+    stack = cache_file(path, cache, '.stack.npy')
+    try:
+        write_atomic(stack, lambda f: np.save(f, intensity))
+        write_atomic(stack + '.stats.npz', lambda f: np.savez(f, **({} if statistics is None else statistics)))
+        # the key is written last, so it only exists for complete stacks
+        key = [INDEX_CACHE_VERSION, digest, str(intensity.dtype), list(intensity.shape)] + source_key(path)
+        write_atomic(stack + '.json', lambda f: json.dump(key, f), mode='w')
+    except OSError:
+        pass
+
+
+def read_stack_cache(path, cache, digest=''):
+    """
+    Maps the frames stored by write_stack_cache for the file at path read only into memory.
+
+    The map shares the page cache with all other processes opening the same stack.
+
+    Returns
+    -------
+    tuple or None
+        The memory mapped frames and the dict of statistics stored with them, None if there is no stack or it
+        belongs to another version of the file.
+
+    """
+    stack = cache_file(path, cache, '.stack.npy')
+    try:
+        with open(stack + '.json') as f:
+            key = json.load(f)
+        if key[:2] != [INDEX_CACHE_VERSION, digest] or key[4:] != source_key(path):
+            return None
+        intensity = np.load(stack, mmap_mode='r')
+        with np.load(stack + '.stats.npz') as stored:
+            statistics = {name: stored[name] for name in stored.files}
+    except (OSError, ValueError, TypeError):
+        return None
+    if str(intensity.dtype) != key[2] or list(intensity.shape) != key[3]:
+        return None
+    return intensity, statistics
+
+
+class FrameCache:
+    """
+    Least recently used cache of decoded frames, shared by all readers of the process.
+
+    Frames are keyed by the identity of the file (see NLPReader.identity) and the address of their image data, so
+    a modified file never returns stale frames. The cached frames are read only. The cache is disabled as long as
+    max_bytes is 0.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Memory budget of the decoded frames in bytes. The default is 0.
+
+    Examples
+    --------
+    >>> frame_cache.max_bytes = 2 * 2 ** 30
+    >>> dataset = xarray.open_dataset('measurement.nlp', engine='pyLEEM')
+    >>> dataset.intensity[100].values  # decoded
+    >>> dataset.intensity[100].values  # from the cache
+    >>> frame_cache.info()
+
+    """
+
+    def __init__(self, max_bytes=0):
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self._max_bytes:
+            _, frame = self._frames.popitem(last=False)
+            self.nbytes -= frame.nbytes
+            self.evictions += 1
+
+    def get(self, key):
+        """
+        Returns the frame stored under key and marks it as recently used, None if it is not cached.
+        """
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is None:
+                self.misses += 1
+                return None
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frame
+
+    def put(self, key, frame):
+        """
+        Stores frame under key, evicting the least recently used frames beyond the budget.
+        Frames larger than the whole budget are not stored.
+        """
+        if frame.nbytes > self._max_bytes:
+            return
+        frame.setflags(write=False)
+        with self._lock:
+            previous = self._frames.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self._frames[key] = frame
+            self.nbytes += frame.nbytes
+            self._evict()
+
+    def clear(self):
+        """
+        Removes all frames and resets the counters.
+        """
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """
+        Returns the counters hits, misses and evictions together with the number of frames, their size in bytes
+        and max_bytes as dict.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'frames': len(self._frames), 'bytes': self.nbytes, 'max_bytes': self._max_bytes}
+
+
+# The decoded frame cache of the process, enabled by setting frame_cache.max_bytes.
+frame_cache = FrameCache()
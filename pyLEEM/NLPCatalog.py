@@ -0,0 +1,323 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import glob
+import os
+import sqlite3
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from pyLEEM.LEEMAnalysis import (load_header, load_frame_meta_data, read_directory, read_frame_header,
+                                 parse_timestamps, to_numeric)
+from pyLEEM.NLPReader import NLPReader
+
+
+def find_NLP(paths_or_glob):
+    """
+    Expands paths, directories and glob patterns to the sorted list of NLP files they contain.
+
+    Parameters
+    ----------
+    paths_or_glob : str or list of str
+        Paths of files, directories which are searched recursively for .nlp files, or glob patterns
+        like 'beamtime/**/*.nlp'.
+
+    """
+    if isinstance(paths_or_glob, (str, os.PathLike)):
+        paths_or_glob = [paths_or_glob]
+    paths = []
+    for entry in map(os.fspath, paths_or_glob):
+        if os.path.isdir(entry):
+            for root, dirs, files in os.walk(entry):
+                paths.extend(os.path.join(root, name) for name in files if name.lower().endswith('.nlp'))
+        elif glob.has_magic(entry):
+            paths.extend(glob.glob(entry, recursive=True))
+        else:
+            paths.append(entry)
+    return sorted(set(paths))
+
+
+def scan_file(path, frame_headers=('first', 'last')):
+    """
+    Reads the file header and the headers of the first and/or last frame of a measurement.
+
+    Parameters
+    ----------
+    path : str
+        Path to the measurement file.
+    frame_headers : tuple of str, optional
+        Which frame headers are read, out of 'first' and 'last'. The default is ('first', 'last').
+
+    Returns
+    -------
+    dict
+        path, size and mtime of the file, the attributes of load_header, the number of frames in the directory as
+        frame_count and the frame header fields as <field>_first and <field>_last.
+        If the file can not be read, error holds the reason.
+
+    """
+    row = {'path': path}
+    try:
+        # broken links and files removed since the search end up in error like unreadable files
+        stat = os.stat(path)
+        row.update({'size': stat.st_size, 'mtime': stat.st_mtime})
+        with NLPReader(path) as reader:
+            header = load_header(reader, verbose=False)
+            row.update({key: value for key, value in header.attrs.items() if key != 'path'})
+            directory = read_directory(reader, header.attrs['directory_position'])
+            blocks = directory['block_start_location'][directory['content_code'] == 1]
+            row['frame_count'] = len(blocks)
+            for which in frame_headers if len(blocks) > 0 else ():
+                frame_header = read_frame_header(reader, int(blocks[{'first': 0, 'last': -1}[which]]))
+                if frame_header is not None:
+                    row.update({name + '_' + which: value for name, value in frame_header.items()})
+    except (OSError, TypeError, ValueError, UnicodeDecodeError, struct.error) as error:
+        row['error'] = str(error)
+    return row
+
+
+def scan_NLP(paths_or_glob, workers=1, frame_headers=('first', 'last'), as_dataframe=False):
+    """
+    Collects the headers of many measurements into one table without loading any frames.
+
+    Only the file header, the directory and the headers of the first and last frame are read from every file.
+
+    Parameters
+    ----------
+    paths_or_glob : str or list of str
+        Files, directories or glob patterns, see find_NLP.
+    workers : int, optional
+        Number of processes scanning files in parallel. The default is 1 which scans in the calling process.
+        When using more than one worker on platforms starting processes by spawning (Windows, macOS), call
+        scan_NLP from within an if __name__ == '__main__' block.
+    frame_headers : tuple of str, optional
+        Which frame headers are read, see scan_file.
+    as_dataframe : bool, optional
+        Return a pandas DataFrame instead of an xarray Dataset. The default is False.
+
+    Returns
+    -------
+    xarray.Dataset or pandas.DataFrame
+        One row per file along the dimension file, with path as coordinate. Header fields which parse as numbers
+        are float64, timestamps are datetime64. Fields missing in a file are NaN.
+
+    Examples
+    --------
+    >>> catalog = scan_NLP('beamtime/**/*.nlp', workers=8)
+    >>> catalog.path[(catalog.STV_first == 3.2) & (catalog.GUN_HV_first == 15000)]
+
+    """
+    paths = find_NLP(paths_or_glob)
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            rows = list(executor.map(scan_file, paths, [frame_headers] * len(paths),
+                                     chunksize=max(1, len(paths) // (4 * workers))))
+    else:
+        rows = [scan_file(path, frame_headers) for path in paths]
+
+    table = pd.DataFrame(rows, columns=None if rows else ['path'])
+    for column in table.columns:
+        if (column in ('path', 'error') or pd.api.types.is_numeric_dtype(table[column])
+                or pd.api.types.is_datetime64_any_dtype(table[column])):
+            continue
+        present = table[column].notna().to_numpy()
+        if column == 'header_timestamp' or column.startswith('time_'):
+            times = np.full(len(table), np.datetime64('NaT'), dtype='datetime64[ns]')
+            times[present] = parse_timestamps(table[column][present].to_numpy(dtype=str))
+            table[column] = times
+            continue
+        numbers = to_numeric(table[column].to_numpy(dtype=object, na_value=np.nan))
+        if numbers is not None:
+            table[column] = numbers
+    table.index.name = 'file'
+    if as_dataframe:
+        return table
+    return xr.Dataset.from_dataframe(table).set_coords('path')
+
+
+def summarize_file(path):
+    """
+    Reads the header and the metadata of all frames of a measurement and summarizes them for NLPCatalog.
+
+    Returns
+    -------
+    dict
+        The row of the files table, the float attributes of the file header as attrs and min, max and mean of every
+        numeric per frame field as frame_fields. If the file can not be read, error holds the reason.
+
+    """
+    summary = {'path': path, 'size': None, 'mtime': None, 'attrs': {}, 'frame_fields': {}}
+    try:
+        stat = os.stat(path)
+        summary.update({'size': stat.st_size, 'mtime': stat.st_mtime})
+        with NLPReader(path) as reader:
+            dataset = load_header(reader, verbose=False)
+            load_frame_meta_data(dataset, reader=reader)
+    except (OSError, TypeError, ValueError, UnicodeDecodeError, struct.error, AttributeError) as error:
+        summary['error'] = str(error)
+        return summary
+    summary['attrs'] = {key: value for key, value in dataset.attrs.items() if isinstance(value, float)}
+    summary['number_of_frames'] = dataset.sizes.get('time', 0)
+    if summary['number_of_frames'] > 0:
+        summary['width'] = int(dataset.width.max())
+        summary['height'] = int(dataset.height.max())
+        summary['bits_per_pixel'] = int(dataset.bits_per_pixel.max())
+        summary['time_start'] = _iso(dataset.time.values.min())
+        summary['time_end'] = _iso(dataset.time.values.max())
+        summary['frame_fields'] = {name: (float(variable.min()), float(variable.max()), float(variable.mean()))
+                                   for name, variable in dataset.data_vars.items() if variable.dtype.kind == 'f'}
+    return summary
+
+
+def _iso(time):
+    # fixed precision, so the stored times compare correctly as strings
+    return np.datetime_as_string(np.datetime64(time, 'us'))
+
+
+class NLPCatalog:
+    """
+    Persistent catalog of NLP measurements in an SQLite database.
+
+    Per file the catalog stores the float attributes of the file header, the number and size of the frames,
+    the time span of the frames and min, max and mean of every numeric per frame field. refresh only reads files
+    which are new or whose size or modification time changed, queries are answered from indexed tables.
+
+    Parameters
+    ----------
+    database : str
+        Path of the SQLite database, created if it does not exist.
+
+    Examples
+    --------
+    >>> with NLPCatalog('leem_catalog.sqlite') as catalog:
+    ...     catalog.refresh('beamtime/', workers=8)
+    ...     paths = catalog.query(start='2019-02-23', stop='2019-02-24', UPRISM_ST=0.01975)
+
+    """
+
+    def __init__(self, database):
+        self.connection = sqlite3.connect(database)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL, number_of_frames INTEGER, width INTEGER,
+                height INTEGER, bits_per_pixel INTEGER, time_start TEXT, time_end TEXT, error TEXT);
+            CREATE TABLE IF NOT EXISTS attrs (
+                path TEXT REFERENCES files(path) ON DELETE CASCADE, key TEXT, value REAL, PRIMARY KEY (path, key));
+            CREATE TABLE IF NOT EXISTS frame_fields (
+                path TEXT REFERENCES files(path) ON DELETE CASCADE, key TEXT, min REAL, max REAL, mean REAL,
+                PRIMARY KEY (path, key));
+            CREATE INDEX IF NOT EXISTS attrs_key_value ON attrs (key, value);
+            CREATE INDEX IF NOT EXISTS frame_fields_key ON frame_fields (key, min, max);
+            CREATE INDEX IF NOT EXISTS files_time ON files (time_start, time_end);
+        ''')
+        self.connection.execute('PRAGMA foreign_keys = ON')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def refresh(self, paths_or_glob, workers=1, remove_missing=False):
+        """
+        Adds new files to the catalog and updates the files whose size or modification time changed.
+
+        Parameters
+        ----------
+        paths_or_glob : str or list of str
+            Files, directories or glob patterns, see find_NLP.
+        workers : int, optional
+            Number of processes reading files in parallel, see scan_NLP. The default is 1.
+        remove_missing : bool, optional
+            Remove catalog entries of files which no longer exist. The default is False.
+
+        Returns
+        -------
+        int
+            The number of files which were read.
+
+        """
+        known = {path: (size, mtime) for path, size, mtime in
+                 self.connection.execute('SELECT path, size, mtime FROM files')}
+        changed = []
+        for path in map(os.path.abspath, find_NLP(paths_or_glob)):
+            try:
+                stat = os.stat(path)
+                key = (stat.st_size, stat.st_mtime)
+            except OSError:
+                # e.g. a dangling link, stored with its error and without size until the file appears
+                key = (None, None)
+            if known.get(path) != key:
+                changed.append(path)
+
+        if workers > 1 and len(changed) > 1:
+            with ProcessPoolExecutor(workers) as executor:
+                summaries = executor.map(summarize_file, changed, chunksize=max(1, len(changed) // (4 * workers)))
+        else:
+            summaries = map(summarize_file, changed)
+
+        columns = ('path', 'size', 'mtime', 'number_of_frames', 'width', 'height', 'bits_per_pixel', 'time_start',
+                   'time_end', 'error')
+        with self.connection:
+            for summary in summaries:
+                self.connection.execute('DELETE FROM files WHERE path = ?', (summary['path'],))
+                self.connection.execute('INSERT INTO files VALUES ({})'.format(', '.join('?' * len(columns))),
+                                        [summary.get(column) for column in columns])
+                self.connection.executemany('INSERT INTO attrs VALUES (?, ?, ?)',
+                                            [(summary['path'], key, value) for key, value in summary['attrs'].items()])
+                self.connection.executemany('INSERT INTO frame_fields VALUES (?, ?, ?, ?, ?)',
+                                            [(summary['path'], key) + values
+                                             for key, values in summary['frame_fields'].items()])
+            if remove_missing:
+                self.connection.executemany('DELETE FROM files WHERE path = ?',
+                                            [(path,) for path in known if not os.path.exists(path)])
+        return len(changed)
+
+    def query(self, start=None, stop=None, tolerance=0, frame_fields=None, **attrs):
+        """
+        Returns the paths of the cataloged files matching all given conditions, ordered by time.
+
+        Parameters
+        ----------
+        start, stop : str or datetime-like, optional
+            Only files whose frames were recorded (partly) between start and stop.
+        tolerance : float, optional
+            Absolute tolerance of the comparisons of attrs and frame_fields. The default is 0 which compares exactly.
+        frame_fields : dict, optional
+            Per frame fields and a value which at least one frame of the file has to reach, judged by the minimum and
+            maximum of the field in the file, e.g. {'STV': 3.2}.
+        **attrs : float
+            Values of file header attributes, e.g. UPRISM_ST=0.01975.
+
+        Returns
+        -------
+        list of str
+
+        """
+        conditions, parameters = ['error IS NULL'], []
+        if start is not None:
+            conditions.append('time_end >= ?')
+            parameters.append(_iso(start))
+        if stop is not None:
+            conditions.append('time_start <= ?')
+            parameters.append(_iso(stop))
+        for key, value in attrs.items():
+            conditions.append('EXISTS (SELECT 1 FROM attrs a WHERE a.path = files.path AND a.key = ? '
+                              'AND a.value BETWEEN ? AND ?)')
+            parameters += [key, value - tolerance, value + tolerance]
+        for key, value in (frame_fields or {}).items():
+            conditions.append('EXISTS (SELECT 1 FROM frame_fields f WHERE f.path = files.path AND f.key = ? '
+                              'AND f.min <= ? AND f.max >= ?)')
+            parameters += [key, value + tolerance, value - tolerance]
+        rows = self.connection.execute('SELECT path FROM files WHERE {} ORDER BY time_start, path'.format(
+            ' AND '.join(conditions)), parameters)
+        return [path for path, in rows]
+
+    def files(self):
+        """
+        Returns the files table of the catalog as a pandas DataFrame.
+        """
+        return pd.read_sql_query('SELECT * FROM files ORDER BY time_start, path', self.connection,
+                                 parse_dates=['time_start', 'time_end'])
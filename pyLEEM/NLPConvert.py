@@ -0,0 +1,151 @@
+import numpy as np
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from pyLEEM.LEEMAnalysis import load_NLP, load_frame_data, frame_dtype
+from pyLEEM.NLPReader import open_reader
+
+
+def convert_NLP(path, target, format=None, frames_per_chunk=16, workers=4, compression_level=5, index_cache=None):
+    """
+    Converts a measurement into a chunked and compressed Zarr store or HDF5 file.
+
+    The frames are decoded chunk by chunk with load_frame_data and compressed on a thread pool, so only about
+    workers + 1 chunks are held in memory. All per frame metadata variables and the header attributes are
+    written alongside the intensity.
+
+    Parameters
+    ----------
+    path : str
+        Path to the measurement file, or anything else accepted by NLPReader.
+    target : str or zarr store
+        The Zarr store or HDF5 file to create, existing ones are overwritten.
+    format : str, optional
+        'zarr' or 'hdf5'. The default is None which picks 'hdf5' for targets ending in .h5 or .hdf5 and 'zarr'
+        otherwise.
+    frames_per_chunk : int, optional
+        Number of frames per chunk, every chunk holds complete frames. The default is 16.
+    workers : int, optional
+        Number of threads decoding and compressing. The default is 4.
+    compression_level : int, optional
+        Compression level, zstd with bitshuffle for Zarr and deflate for HDF5. The default is 5.
+    index_cache : bool or str, optional
+        See load_NLP.
+
+    Raises
+    ------
+    ImportError
+        Raised if zarr or h5py, depending on the format, is not installed.
+
+    Returns
+    -------
+    None.
+
+    Examples
+    --------
+    >>> convert_NLP('measurement.nlp', 'measurement.zarr')
+    >>> xarray.open_zarr('measurement.zarr').intensity
+
+    """
+    if format is None:
+        format = 'hdf5' if str(target).lower().endswith(('.h5', '.hdf5')) else 'zarr'
+    if format not in ('zarr', 'hdf5'):
+        raise ValueError('Unknown format {}, use zarr or hdf5!'.format(format))
+
+    with open_reader(path) as reader:
+        dataset = load_NLP(reader, frame_loading='none', index_cache=index_cache)
+        number_of_frames = dataset.sizes['time']
+        shape = (number_of_frames, int(dataset.height.max()), int(dataset.width.max()))
+        dtype = frame_dtype(int(dataset.bits_per_pixel.max()))
+        # HDF5 chunks may not be larger than the dataset
+        frames_per_chunk = max(1, min(frames_per_chunk, number_of_frames))
+        chunks = (frames_per_chunk,) + shape[1:]
+
+        if format == 'zarr':
+            intensity, compress, write, close = _zarr_target(dataset, target, shape, chunks, dtype, compression_level)
+        else:
+            intensity, compress, write, close = _hdf5_target(dataset, target, shape, chunks, dtype, compression_level)
+
+        try:
+            with ThreadPoolExecutor(max(workers, 1)) as executor:
+                pending = []
+                for start in tqdm(range(0, number_of_frames, frames_per_chunk), desc="Converting chunks..."):
+                    block = load_frame_data(dataset, np.s_[start:start + frames_per_chunk], statistics=(),
+                                            num_workers=workers, reader=reader, progress=False).intensity.values
+                    pending.append(executor.submit(compress, start, block))
+                    # bounds the number of decoded chunks in memory
+                    while len(pending) > workers:
+                        write(*pending.pop(0).result())
+                for future in pending:
+                    write(*future.result())
+        finally:
+            close()
+
+
+def _zarr_target(dataset, target, shape, chunks, dtype, compression_level):
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError('Converting to Zarr requires the zarr package, install it with pip install zarr.')
+    dataset.to_zarr(target, mode='w', consolidated=False)
+    group = zarr.open_group(target, mode='a')
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        intensity = group.create_array(
+            'intensity', shape=shape, chunks=chunks, dtype=dtype, dimension_names=['time', 'y', 'x'],
+            compressors=zarr.codecs.BloscCodec(cname='zstd', clevel=compression_level, shuffle='bitshuffle'))
+    else:
+        import numcodecs
+        intensity = group.create_dataset(
+            'intensity', shape=shape, chunks=chunks, dtype=dtype,
+            compressor=numcodecs.Blosc(cname='zstd', clevel=compression_level, shuffle=numcodecs.Blosc.BITSHUFFLE))
+        intensity.attrs['_ARRAY_DIMENSIONS'] = ['time', 'y', 'x']
+
+    def compress(start, block):
+        # zarr compresses and stores the chunk in the worker thread
+        intensity[start:start + len(block)] = block
+        return ()
+
+    def write():
+        pass
+
+    def close():
+        zarr.consolidate_metadata(target)
+
+    return intensity, compress, write, close
+
+
+def _hdf5_target(dataset, target, shape, chunks, dtype, compression_level):
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('Converting to HDF5 requires the h5py package, install it with pip install h5py.')
+    h5 = h5py.File(target, 'w')
+    h5.attrs.update({key: value for key, value in dataset.attrs.items()})
+    for name, variable in dataset.variables.items():
+        values = variable.values
+        if values.dtype.kind == 'M':
+            values = values.astype('datetime64[ns]').view(np.int64)
+        elif values.dtype.kind == 'U':
+            values = np.char.encode(values, 'utf-8')
+        h5.create_dataset(name, data=values)
+    h5['time'].attrs['units'] = 'nanoseconds since 1970-01-01'
+    h5['time'].make_scale('time')
+    intensity = h5.create_dataset('intensity', shape=shape, chunks=chunks, dtype=dtype, compression='gzip',
+                                  compression_opts=compression_level)
+    for name in list(dataset.data_vars) + ['intensity']:
+        h5[name].dims[0].attach_scale(h5['time'])
+
+    def compress(start, block):
+        # HDF5 chunks always have the full size, the deflate filter of HDF5 is a plain zlib stream
+        if len(block) < chunks[0]:
+            block = np.concatenate([block, np.zeros((chunks[0] - len(block),) + block.shape[1:], dtype=dtype)])
+        return start, zlib.compress(np.ascontiguousarray(block, dtype=dtype).tobytes(), compression_level)
+
+    def write(start, compressed):
+        # h5py is not thread safe, so only the compression runs in parallel
+        intensity.id.write_direct_chunk((start, 0, 0), compressed)
+
+    def close():
+        h5.close()
+
+    return intensity, compress, write, close
@@ -0,0 +1,186 @@
+import numpy as np
+import contextlib
+import io
+import mmap
+import os
+import threading
+
+
+class NLPReader:
+    """
+    Positional read access to an NLP file which is opened only once.
+
+    All reads take an explicit offset, so they do not depend on a shared file position and can be issued from many
+    threads at once. Files are read with os.pread, or through an mmap on platforms without it, in memory sources are
+    sliced. Only file objects without a file descriptor serialize seek and read with a lock.
+
+    Parameters
+    ----------
+    source : str, os.PathLike, binary file object, bytes, bytearray, memoryview or mmap.mmap
+        The measurement. Paths are opened and closed by the reader, file objects and buffers are only borrowed.
+
+    Raises
+    ------
+    TypeError
+        Raised if source is none of the above.
+
+    """
+
+    def __init__(self, source):
+        self.path = None
+        self.buffer = None
+        self._file = None
+        self._fd = None
+        self._owns_file = False
+        self._mmap = None
+        self._lock = threading.Lock()
+        if isinstance(source, (str, os.PathLike)):
+            self.path = os.fspath(source)
+            self._file = open(self.path, "rb")
+            self._owns_file = True
+        elif isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+            self.buffer = memoryview(source).cast('B')
+        elif hasattr(source, 'read') and hasattr(source, 'seek'):
+            self._file = source
+            if isinstance(getattr(source, 'name', None), str):
+                self.path = source.name
+        else:
+            raise TypeError('Can not read an NLP file from {}!'.format(type(source).__name__))
+        # device, inode, size and modification time of the file, None for sources without file descriptor
+        self.identity = None
+        if self._file is not None:
+            try:
+                fd = self._file.fileno()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                fd = None
+            if fd is not None:
+                stat = os.fstat(fd)
+                self.identity = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if fd is not None and hasattr(os, 'pread'):
+                self._fd = fd
+            elif fd is not None:
+                try:
+                    self._mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                    self.buffer = memoryview(self._mmap)
+                except (OSError, ValueError):
+                    # e.g. empty files can not be mapped
+                    pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Closes the file if it was opened by the reader.
+        """
+        if self._mmap is not None:
+            try:
+                self.buffer.release()
+                self._mmap.close()
+            except BufferError:
+                # arrays returned by memmap still use the mapping, it is closed once they are gone
+                pass
+        if self._owns_file:
+            self._file.close()
+
+    @property
+    def size(self):
+        """
+        Size of the source in bytes.
+        """
+        if self.buffer is not None:
+            return len(self.buffer)
+        if self._fd is not None:
+            return os.fstat(self._fd).st_size
+        with self._lock:
+            return self._file.seek(0, io.SEEK_END)
+
+    def pread(self, size, offset):
+        """
+        Reads up to size bytes at offset, fewer only at the end of the source.
+
+        Returns
+        -------
+        bytes or memoryview
+            A memoryview into in memory sources, bytes otherwise.
+
+        """
+        if self.buffer is not None:
+            return self.buffer[offset:offset + size]
+        if self._fd is not None:
+            # a single pread returns at most about 2 GB
+            chunks = []
+            read = 0
+            while read < size:
+                chunk = os.pread(self._fd, size - read, offset + read)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                read += len(chunk)
+            return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def readinto(self, buffer, offset):
+        """
+        Fills the writable byte buffer with the bytes at offset and returns the number of bytes read.
+        """
+        buffer = memoryview(buffer).cast('B')
+        if self.buffer is not None:
+            data = self.buffer[offset:offset + len(buffer)]
+            buffer[:len(data)] = data
+            return len(data)
+        if self._fd is not None and hasattr(os, 'preadv'):
+            read = 0
+            while read < len(buffer):
+                n = os.preadv(self._fd, [buffer[read:]], offset + read)
+                if n == 0:
+                    break
+                read += n
+            return read
+        data = self.pread(len(buffer), offset)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def memmap(self):
+        """
+        Maps the whole source into memory.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            uint8 array over the bytes of the source, None if the source can not be mapped.
+
+        """
+        if self.buffer is not None:
+            return np.frombuffer(self.buffer, dtype=np.uint8)
+        if self._owns_file:
+            return np.memmap(self.path, dtype=np.uint8, mode='r')
+        if self._fd is not None:
+            # mapping the descriptor leaves the position of a borrowed file object untouched, unlike np.memmap
+            try:
+                return np.frombuffer(mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+            except (OSError, ValueError):
+                return None
+        if self.path is not None:
+            return np.memmap(self.path, dtype=np.uint8, mode='r')
+        return None
+
+
+@contextlib.contextmanager
+def open_reader(source):
+    """
+    Context manager providing an NLPReader for source. Readers are passed through and left open.
+    """
+    if isinstance(source, NLPReader):
+        yield source
+        return
+    reader = NLPReader(source)
+    try:
+        yield reader
+    finally:
+        reader.close()
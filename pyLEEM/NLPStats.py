@@ -0,0 +1,171 @@
+import contextlib
+import logging
+import threading
+import tracemalloc
+from time import perf_counter
+
+logger = logging.getLogger('pyLEEM')
+
+# The LoadStats collecting the stages while instrument is active, None otherwise.
+_active = None
+
+
+class LoadStats:
+    """
+    Wall time, bytes and peak allocation of the loading stages, collected by instrument.
+
+    The stages are 'header', 'directory', 'metadata', 'io', 'zlib', 'delta', 'statistics' and 'assembly'.
+    Stages running on several threads at once add up their wall times, so the sum may exceed the elapsed time.
+
+    Attributes
+    ----------
+    stages : dict
+        For every stage that ran a dict with calls, seconds, bytes_read, bytes_decompressed and peak_memory.
+        peak_memory is the largest increase of the traced memory during one call, it is only measured if
+        instrument was called with memory=True and is approximate if other threads allocate at the same time.
+
+    """
+
+    def __init__(self, memory=False, callback=None):
+        self.memory = memory
+        self.callback = callback
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, bytes_read=0, bytes_decompressed=0, peak_memory=0):
+        """
+        Adds one call of stage.
+        """
+        with self._lock:
+            entry = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0., 'bytes_read': 0,
+                                                   'bytes_decompressed': 0, 'peak_memory': 0})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['bytes_read'] += bytes_read
+            entry['bytes_decompressed'] += bytes_decompressed
+            entry['peak_memory'] = max(entry['peak_memory'], peak_memory)
+        if self.callback is not None:
+            self.callback(stage, seconds, bytes_read, bytes_decompressed, peak_memory)
+
+    def to_dataframe(self):
+        """
+        Returns the stages as pandas DataFrame with one row per stage.
+        """
+        import pandas as pd
+        return pd.DataFrame.from_dict(self.stages, orient='index')
+
+    def __repr__(self):
+        return '\n'.join(['LoadStats'] + ['{:>10}: {calls:6d} calls {seconds:9.4f} s {bytes_read:12d} bytes read '
+                                          '{bytes_decompressed:12d} bytes decompressed {peak_memory:12d} bytes peak'
+                                          .format(name, **entry) for name, entry in self.stages.items()])
+
+
+class _Stage:
+    """
+    Times one call of a stage, bytes_read and bytes_decompressed are set inside the with block.
+    """
+    __slots__ = ('stats', 'name', 'bytes_read', 'bytes_decompressed', 'start', 'memory_start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.bytes_read = 0
+        self.bytes_decompressed = 0
+
+    def __enter__(self):
+        if self.stats.memory:
+            tracemalloc.reset_peak()
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = perf_counter() - self.start
+        peak_memory = max(tracemalloc.get_traced_memory()[1] - self.memory_start, 0) if self.stats.memory else 0
+        self.stats.record(self.name, seconds, self.bytes_read, self.bytes_decompressed, peak_memory)
+
+
+class _NoStage:
+    """
+    Stands in for _Stage while nothing is instrumented, everything set on it is discarded.
+    """
+    bytes_read = 0
+    bytes_decompressed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    """
+    Context manager timing the stage name if instrument is active, a shared no-op otherwise.
+    """
+    stats = _active
+    if stats is None:
+        return _NO_STAGE
+    return _Stage(stats, name)
+
+
+def current():
+    """
+    Returns the active LoadStats, None while nothing is instrumented. For code timing many small pieces of a stage
+    itself and recording them with LoadStats.record once.
+    """
+    return _active
+
+
+@contextlib.contextmanager
+def instrument(memory=False, callback=None):
+    """
+    Collects timing and memory statistics of all loading stages while the with block runs.
+
+    Without an active instrument the stages cost a single global lookup each. The collected stages are logged as
+    one record per stage at INFO level to the logger 'pyLEEM' when the block ends.
+
+    Parameters
+    ----------
+    memory : bool, optional
+        Also measure the peak allocation per stage with tracemalloc, which slows down loading noticeably.
+        The default is False.
+    callback : callable, optional
+        Called as callback(stage, seconds, bytes_read, bytes_decompressed, peak_memory) after every call of a stage,
+        possibly from worker threads. The default is None.
+
+    Yields
+    ------
+    LoadStats
+        The statistics, complete once the with block has ended.
+
+    Examples
+    --------
+    >>> with instrument() as stats:
+    ...     dataset = load_NLP('measurement.nlp', num_workers=4)
+    >>> stats.to_dataframe()
+
+    """
+    global _active
+    stats = LoadStats(memory, callback)
+    previous = _active
+    start_tracing = memory and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    _active = stats
+    try:
+        yield stats
+    finally:
+        _active = previous
+        if start_tracing:
+            tracemalloc.stop()
+        for name, entry in stats.stages.items():
+            logger.info('%s: %d calls, %.4f s, %d bytes read, %d bytes decompressed, %d bytes peak', name,
+                        entry['calls'], entry['seconds'], entry['bytes_read'], entry['bytes_decompressed'],
+                        entry['peak_memory'])
@@ -0,0 +1,120 @@
+import numpy as np
+import struct
+import zlib
+from datetime import datetime, timedelta
+from pyLEEM.LEEMAnalysis import IMAGE_HEADER, DIRECTORY_DTYPE, frame_dtype
+
+HEADER_SIZE = 4096
+
+
+def write_NLP(path, frames, compression=True, bits_per_pixel=None, attrs=None, meta_data=None, start_time=None,
+              frame_interval=1., compression_level=6):
+    """
+    Writes frames to a new NLP4 file with file header, one IMG00 block per frame and the directory.
+
+    frames are written one at a time, so a generator of frames produces files of any size in constant memory.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file to create, an existing file is overwritten.
+    frames : numpy.ndarray or iterable of numpy.ndarray
+        Stack of shape (time, height, width) or the single frames of shape (height, width).
+    compression : bool, optional
+        Store the frames delta encoded and zlib compressed (compression code 3) instead of raw. The default is True.
+    bits_per_pixel : int, optional
+        8 or 16. The default is None which uses 8 for uint8 and int8 frames and 16 otherwise.
+    attrs : dict, optional
+        Numeric fields of the file header, e.g. {'GUN': 0.707469}. The default is None.
+    meta_data : dict, optional
+        Fields of the frame headers, e.g. {'GUN_HV': 15000., 'STV': stv}. A value is either used for every frame or
+        a sequence with one value per frame. The default is None.
+    start_time : datetime.datetime, optional
+        Time of the first frame. The default is None which uses the current time.
+    frame_interval : float, optional
+        Seconds between two frames, used for the timestamps, CLK and grab_time. The default is 1.
+    compression_level : int, optional
+        zlib compression level. The default is 6.
+
+    Raises
+    ------
+    ValueError
+        Raised if bits_per_pixel is neither 8 nor 16 or a frame is not two dimensional.
+
+    Returns
+    -------
+    int
+        The number of frames written.
+
+    Examples
+    --------
+    >>> write_NLP('synthetic.nlp', np.random.randint(0, 4096, (10, 512, 512), dtype=np.uint16),
+    ...           meta_data={'STV': np.linspace(0, 10, 10)})
+    >>> load_NLP('synthetic.nlp').STV
+
+    """
+    attrs = {} if attrs is None else attrs
+    meta_data = {} if meta_data is None else meta_data
+    start_time = datetime.now().replace(microsecond=0) if start_time is None else start_time
+    directory = []
+    with open(path, 'wb') as f:
+        # the header is written last, once the number of frames and the directory position are known
+        f.write(bytes(HEADER_SIZE))
+        position = HEADER_SIZE
+        for i, frame in enumerate(frames):
+            frame = np.asarray(frame)
+            if frame.ndim != 2:
+                raise ValueError('Frames need to be two dimensional, got shape {}!'.format(frame.shape))
+            if bits_per_pixel is None:
+                bits_per_pixel = 8 if frame.dtype.itemsize == 1 else 16
+            if bits_per_pixel not in (8, 16):
+                raise ValueError('Only 8 and 16 bit frames can be written, not {}!'.format(bits_per_pixel))
+            fields = {name: value[i] if np.ndim(value) > 0 else value for name, value in meta_data.items()}
+            block = image_block(frame, bits_per_pixel, compression, compression_level, i + 1, i * frame_interval,
+                                start_time + timedelta(seconds=i * frame_interval), fields)
+            f.write(block)
+            directory.append((i + 1, 1, position))
+            position += len(block)
+
+        # like the instrument, the directory lists itself as last entry with frame number 0 and content code 2
+        number_of_frames = len(directory)
+        directory.append((0, 2, position))
+        entries = np.zeros(len(directory), dtype=DIRECTORY_DTYPE)
+        entries['frame_number'], entries['content_code'], entries['block_start_location'] = (
+            np.asarray(directory, dtype=np.int64).reshape(-1, 3).T)
+        f.write(struct.pack('<I5sI', 13 + entries.nbytes, b'DIR00', len(entries)) + entries.tobytes())
+
+        header = 'NLP4\n{:12d}\n{}\n{:12d}\n{:12d}\n{:12d}\n'.format(
+            HEADER_SIZE, start_time.strftime('%a %b %d %H:%M:%S %Y'), number_of_frames, position, 0)
+        header += ''.join('{} {:f}\n'.format(key, value) for key, value in attrs.items())
+        header = header.encode('windows-1252')
+        if len(header) > HEADER_SIZE:
+            raise ValueError('The file header attributes exceed {} bytes!'.format(HEADER_SIZE))
+        f.seek(0)
+        f.write(header)
+    return number_of_frames
+
+
+def image_block(frame, bits_per_pixel, compression, compression_level, frame_number, grab_time, time, fields):
+    """
+    Encodes a single frame with its header as IMG00 block.
+    """
+    dtype = frame_dtype(bits_per_pixel)
+    data = np.ascontiguousarray(frame, dtype=dtype).reshape(-1)
+    if compression:
+        # differences of neighbouring pixels wrap around in the unsigned dtype, the cumulative sum undoes them
+        deltas = np.empty_like(data)
+        deltas[:1] = data[:1]
+        np.subtract(data[1:], data[:-1], out=deltas[1:])
+        data = zlib.compress(deltas, compression_level)
+    else:
+        data = data.tobytes()
+
+    header = '*TTT {}\n*CLK  {:.2f}\n'.format(time.strftime('%a %b %d %H:%M:%S %Y'), grab_time)
+    header += ''.join('*{} {}\n'.format(name, value if isinstance(value, str) else '{:+f}'.format(value))
+                      for name, value in fields.items())
+    header = header.encode('windows-1252')
+    image_header = IMAGE_HEADER.pack(frame_number, grab_time, frame.shape[1], frame.shape[0], bits_per_pixel, 0,
+                                     3 if compression else 0)
+    body = b'IMG00' + struct.pack('<I', len(header)) + header + image_header + bytes(48)
+    return struct.pack('<I', 4 + len(body) + 4 + len(data)) + body + struct.pack('<I', len(data)) + data
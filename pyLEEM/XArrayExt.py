@@ -1,6 +1,182 @@
-from xarray.backends import BackendEntrypoint
-from pyLEEM.LEEMAnalysis import load_NLP
-import xarray 
+from xarray.backends import BackendEntrypoint, BackendArray
+from xarray.core import indexing
+from pyLEEM.NLPReader import NLPReader, open_reader
+import numpy as np
+import xarray
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class NLPBackendArray(BackendArray):
+    """
+    Lazily indexed view on the frames of an NLP file.
+
+    Only the frame table (image addresses, bit depth and compression of every frame) is kept in memory,
+    the frames themselves are read and decoded when a selection touches them.
+    source is the path of the file or an open NLPReader. Paths are opened once per process on first access and
+    read with positional reads, so any number of threads can fetch frames at the same time without a lock.
+    """
+
+    def __init__(self, source, dataset):
+        from pyLEEM.LEEMAnalysis import frame_dtype
+        self.source = source
+        self.image_address = dataset.image_address.values
+        self.bits_per_pixel = dataset.bits_per_pixel.values
+        self.compression_code = dataset.compression_code.values
+        self.shape = (self.image_address.shape[0], int(dataset.height.max()), int(dataset.width.max()))
+        self.dtype = frame_dtype(int(self.bits_per_pixel.max()))
+        self._reader = None
+        self._reader_lock = threading.Lock()
+
+    def __getstate__(self):
+        # the reader is opened again in the process unpickling the array
+        state = self.__dict__.copy()
+        state['_reader'] = None
+        state['_reader_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reader_lock = threading.Lock()
+
+    @property
+    def reader(self):
+        if isinstance(self.source, NLPReader):
+            return self.source
+        if self._reader is None:
+            with self._reader_lock:
+                if self._reader is None:
+                    self._reader = NLPReader(self.source)
+        return self._reader
+
+    def close(self):
+        """
+        Closes the reader opened by the array, readers passed as source are left open.
+        """
+        with self._reader_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key, self.shape, indexing.IndexingSupport.OUTER, self._raw_indexing_method)
+
+    def _raw_indexing_method(self, key):
+        from pyLEEM.LEEMAnalysis import read_frame
+        frames = np.arange(self.shape[0])[key[0]]
+        height, width = self.shape[1:]
+        data = np.empty((np.size(frames), height, width), dtype=self.dtype)
+        reader = self.reader
+        for n, i in enumerate(np.atleast_1d(frames)):
+            data[n] = read_frame(reader, self.image_address[i], self.bits_per_pixel[i], self.compression_code[i],
+                                 height, width)
+        # outer indexing, last axis first so integer keys do not shift the following axes
+        for axis in (2, 1):
+            data = data[(slice(None),) * axis + (key[axis],)]
+        return data[0] if np.ndim(frames) == 0 else data
+
+
+class NLPMultiBackendArray(BackendArray):
+    """
+    Lazily indexed view on the frames of consecutive NLP files, concatenated along time.
+
+    arrays are the NLPBackendArray of every file, a selection is split by file and only the files holding selected
+    frames are read.
+    """
+
+    def __init__(self, arrays):
+        if len({array.shape[1:] for array in arrays}) > 1:
+            raise ValueError('The frames of all files need the same height and width!')
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + [array.shape[0] for array in arrays])
+        self.shape = (int(self.offsets[-1]),) + arrays[0].shape[1:]
+        self.dtype = np.result_type(*[array.dtype for array in arrays])
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key, self.shape, indexing.IndexingSupport.OUTER, self._raw_indexing_method)
+
+    def _raw_indexing_method(self, key):
+        frames = np.arange(self.shape[0])[key[0]]
+        data = np.empty((np.size(frames),) + self.shape[1:], dtype=self.dtype)
+        file_index = np.searchsorted(self.offsets, np.atleast_1d(frames), side='right') - 1
+        for f in np.unique(file_index):
+            selected = file_index == f
+            data[selected] = self.arrays[f]._raw_indexing_method(
+                (np.atleast_1d(frames)[selected] - self.offsets[f], slice(None), slice(None)))
+        for axis in (2, 1):
+            data = data[(slice(None),) * axis + (key[axis],)]
+        return data[0] if np.ndim(frames) == 0 else data
+
+
+def open_mfNLP(paths, workers=4, index_cache=None, chunks=None):
+    """
+    Opens consecutive measurement files as one lazily loaded dataset concatenated along time.
+
+    Only the headers and directories are read, in parallel across the files. The frames are decoded when they are
+    accessed and a selection only reads the files it touches.
+
+    Parameters
+    ----------
+    paths : list of str or str
+        Measurement files in the order of concatenation. A str is a directory or glob pattern, see find_NLP.
+    workers : int, optional
+        Number of files read at the same time. The default is 4.
+    index_cache : bool or str, optional
+        See load_NLP.
+    chunks : dict, optional
+        If given the intensity is wrapped in a dask array with these chunks, e.g. {'time': 16}. The default is None.
+
+    Raises
+    ------
+    ValueError
+        Raised if no files are given or the frames of the files differ in size.
+
+    Returns
+    -------
+    dataset : xarray.Dataset
+        The concatenated metadata with a lazy intensity, the coordinate path tells the file of every frame.
+        Attributes are kept where they agree between all files.
+
+    Examples
+    --------
+    >>> dataset = open_mfNLP('measurements/2019*.nlp')
+    >>> dataset.intensity.sel(time=slice('2019-02-23T18:56', '2019-02-23T19:10')).mean('time')
+
+    """
+    from pyLEEM.LEEMAnalysis import load_NLP
+    if isinstance(paths, (str, os.PathLike)):
+        from pyLEEM.NLPCatalog import find_NLP
+        paths = find_NLP(os.fspath(paths))
+    paths = [os.fspath(path) for path in paths]
+    if not paths:
+        raise ValueError('No measurement files given!')
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        datasets = list(executor.map(lambda path: load_NLP(path, frame_loading='none', index_cache=index_cache),
+                                     paths))
+    datasets = [dataset.assign_coords(path=('time', np.full(dataset.sizes['time'], path)))
+                for dataset, path in zip(datasets, paths)]
+    arrays = [NLPBackendArray(path, dataset) for dataset, path in zip(datasets, paths)
+              if dataset.sizes['time'] > 0]
+
+    def close():
+        for array in arrays:
+            array.close()
+
+    dataset = xarray.concat(datasets, dim='time', data_vars='all', coords='different', compat='equals',
+                            join='outer', combine_attrs='drop_conflicts')
+    dataset.attrs.pop('path', None)
+    if arrays:
+        dataset['intensity'] = xarray.Variable(
+            ['time', 'y', 'x'], indexing.LazilyIndexedArray(NLPMultiBackendArray(arrays)))
+    if chunks is not None:
+        dataset = dataset.chunk(chunks)
+    dataset.set_close(close)
+    return dataset
+
+
 class NLPBackend(BackendEntrypoint):
     def open_dataset(
         self,
@@ -10,16 +186,39 @@ class NLPBackend(BackendEntrypoint):
         # other backend specific keyword arguments
         # `chunks` and `cache` DO NOT go here, they are handled by xarray
     ):
-        return load_NLP(filename_or_obj)
+        # imported here, xarray imports this module for every open_dataset call to find its backends
+        from pyLEEM.LEEMAnalysis import load_NLP
+        if isinstance(filename_or_obj, (str, os.PathLike)):
+            source = os.fspath(filename_or_obj)
+        else:
+            # file objects and buffers stay open as long as the dataset
+            source = NLPReader(filename_or_obj)
+        dataset = load_NLP(source, frame_loading='none')
+        array = NLPBackendArray(source, dataset)
+        if len(dataset.image_address) > 0:
+            dataset['intensity'] = xarray.Variable(['time', 'y', 'x'], indexing.LazilyIndexedArray(array))
+        if drop_variables is not None:
+            dataset = dataset.drop_vars(drop_variables, errors='ignore')
+
+        def close():
+            array.close()
+            if isinstance(source, NLPReader):
+                source.close()
+        dataset.set_close(close)
+        return dataset
 
     open_dataset_parameters = ["filename_or_obj", "drop_variables"]
 
-    def guess_can_open(self,filename_or_obj):
+    def guess_can_open(self, filename_or_obj):
+        if isinstance(filename_or_obj, (str, os.PathLike)):
+            # the extension decides without opening the file
+            if os.fspath(filename_or_obj).lower().endswith('.nlp'):
+                return True
+            if not os.path.isfile(filename_or_obj):
+                return False
         try:
-            with open(filename_or_obj, "rb") as f:
-                header = f.read(5).decode()
-        except TypeError:
+            with open_reader(filename_or_obj) as reader:
+                return bytes(reader.pread(5, 0)) == b'NLP4\n'
+        except (TypeError, OSError):
             return False
-        return header == 'NLP4\n'
-    
-    
\ No newline at end of file
+
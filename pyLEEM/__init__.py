@@ -1,3 +1,20 @@
+import importlib
 
-from . import _version
-__version__ = _version.get_versions()['version']
+# The submodules and the version are loaded on first access, so importing pyLEEM itself is almost free.
+_SUBMODULES = ('LEEMAnalysis', 'NLPCache', 'NLPCatalog', 'NLPConvert', 'NLPReader', 'NLPStats', 'NLPWriter',
+               'XArrayExt')
+
+
+def __getattr__(name):
+    if name == '__version__':
+        # versioneer asks git in source trees and reads the static _version.py it writes into built packages
+        from . import _version
+        globals()['__version__'] = _version.get_versions()['version']
+        return globals()['__version__']
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + ['__version__'] + list(_SUBMODULES))
@@ -23,7 +23,7 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.9',
     install_requires=requirements,
     entry_points={
         "xarray.backends": ["pyLEEM=pyLEEM.XArrayExt:NLPBackend"],
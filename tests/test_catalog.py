@@ -0,0 +1,41 @@
+import os
+import numpy as np
+from pyLEEM.NLPCatalog import scan_NLP
+
+
+def test_scan_NLP():
+    Test = scan_NLP(os.path.join("tests", "data"))
+    assert Test.sizes['file'] == 1
+    assert Test.frame_count.values[0] == 1
+    assert Test.UPRISM_ST.values[0] == 0.01975
+    assert Test.GUN_HV_first.values[0] == Test.GUN_HV_last.values[0] == 15000.0
+    assert Test.time_first.values[0] == np.datetime64('2019-02-23T18:56:58')
+
+def test_scan_NLP_glob():
+    Test = scan_NLP(os.path.join("tests", "**", "*.nlp"), workers=2, frame_headers=('first',), as_dataframe=True)
+    assert len(Test) == 1 and 'GUN_HV_last' not in Test
+
+def test_NLPCatalog(tmp_path):
+    from pyLEEM.NLPCatalog import NLPCatalog
+    with NLPCatalog(str(tmp_path / "catalog.sqlite")) as catalog:
+        assert catalog.refresh(os.path.join("tests", "data")) == 1
+        assert catalog.refresh(os.path.join("tests", "data")) == 0
+        assert len(catalog.query(UPRISM_ST=0.01975, start='2019-02-23', stop='2019-02-24')) == 1
+        assert catalog.query(UPRISM_ST=0.02) == []
+        assert len(catalog.query(frame_fields={'GUN_HV': 15000.0})) == 1
+        assert catalog.files().number_of_frames[0] == 1
+
+def test_scan_NLP_missing(tmp_path):
+    os.symlink(str(tmp_path / "deleted.nlp"), str(tmp_path / "broken.nlp"))
+    Test = scan_NLP([os.path.join("tests", "data"), str(tmp_path)], as_dataframe=True)
+    assert len(Test) == 2
+    assert Test.error.isna().sum() == 1 and Test.frame_count.notna().sum() == 1
+
+def test_NLPCatalog_missing(tmp_path):
+    from pyLEEM.NLPCatalog import NLPCatalog
+    os.symlink(str(tmp_path / "deleted.nlp"), str(tmp_path / "broken.nlp"))
+    with NLPCatalog(str(tmp_path / "catalog.sqlite")) as catalog:
+        assert catalog.refresh([os.path.join("tests", "data"), str(tmp_path)]) == 2
+        assert catalog.refresh([os.path.join("tests", "data"), str(tmp_path)]) == 0
+        files = catalog.files()
+        assert files.error.notna().sum() == 1 and files.number_of_frames.sum() == 1
@@ -0,0 +1,27 @@
+import os
+import numpy as np
+import pytest
+import xarray as xr
+from pyLEEM.LEEMAnalysis import load_NLP
+from pyLEEM.NLPConvert import convert_NLP
+
+
+def test_convert_zarr(tmp_path):
+    pytest.importorskip("zarr")
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    target = str(tmp_path / "test.zarr")
+    convert_NLP(path, target, frames_per_chunk=4, workers=2)
+    Test = xr.open_zarr(target)
+    assert np.array_equal(Test.intensity.values, load_NLP(path).intensity.values)
+    assert Test.GUN_HV.values[0] == 15000.0
+    assert Test.attrs['UPRISM_ST'] == 0.01975
+
+def test_convert_hdf5(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    target = str(tmp_path / "test.h5")
+    convert_NLP(path, target, frames_per_chunk=4, workers=2)
+    with h5py.File(target, 'r') as Test:
+        assert np.array_equal(Test['intensity'][:], load_NLP(path).intensity.values)
+        assert Test['GUN_HV'][0] == 15000.0
+        assert Test.attrs['UPRISM_ST'] == 0.01975
@@ -1,6 +1,8 @@
 from xarray import *
 import pkg_resources
 import os
+import pytest
+import numpy as np
 
 def test_ESCHERnlp_read():
     path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
@@ -10,7 +12,7 @@ def test_ESCHERnlp_read():
 def test_ESCHER_frameMetaData():
     path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")   
     Test = open_dataset(path, engine='pyLEEM')
-    assert Test.GUN_HV.values[0] == '+15000.000000'
+    assert Test.GUN_HV.values[0] == 15000.0
     
 def test_ESCHER_metaData():
     path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")    
@@ -23,4 +25,391 @@ def test_XArrayBackendReg():
 def test_XArrayBackend():
     path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
     Test = open_dataset(path, engine='pyLEEM')
-    assert Test.intensity.values[-1,-1,-1] == 1163.0
\ No newline at end of file
+    assert Test.intensity.values[-1,-1,-1] == 1163.0
+
+def test_XArrayBackendLazy():
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Test = open_dataset(path, engine='pyLEEM')
+    assert not Test.intensity.variable._in_memory
+    assert Test.intensity[0, 1000:, -5:].values[-1, -1] == 1163.0
+    assert Test.intensity.isel(x=-1).values[0, -1] == 1163.0
+
+def test_XArrayBackendChunks():
+    pytest.importorskip("dask")
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Test = open_dataset(path, engine='pyLEEM', chunks={'time': 1})
+    assert Test.intensity.chunks is not None
+    assert Test.intensity[:, -1, -1].compute().values[0] == 1163.0
+
+def test_ESCHER_directory():
+    from pyLEEM.LEEMAnalysis import read_directory
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    with open(path, "rb") as f:
+        directory = read_directory(f, 2629776)
+    assert directory['content_code'].tolist() == [1, 2]
+    assert directory['block_start_location'].tolist() == [4096, 2629776]
+
+def test_ESCHER_nativeDtype():
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Test = load_NLP(path)
+    assert Test.intensity.dtype == 'uint16'
+    assert load_NLP(path, dtype='float32').intensity.dtype == 'float32'
+    assert open_dataset(path, engine='pyLEEM').intensity.dtype == 'uint16'
+
+def test_ESCHER_numWorkers():
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Test = load_NLP(path, num_workers=4)
+    assert Test.intensity.values[-1, -1, -1] == 1163
+    assert Test.max_counts.values[0] == 48959
+
+def test_ESCHER_frameSelection():
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Test = load_NLP(path, frames=[-1])
+    assert Test.intensity.shape == (1, 1024, 1280)
+    assert load_NLP(path, frame_loading='ten').intensity.values[-1, -1, -1] == 1163
+    Empty = load_NLP(path, grab_time=(0, 1000))
+    assert Empty.sizes['time'] == 0
+    assert load_NLP(path, time=('2019-02-23T18:56:58', None)).sizes['time'] == 1
+
+def test_ESCHER_memmap():
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Test = load_NLP(path, memmap=True)
+    assert isinstance(Test.intensity.data.base, np.memmap)
+    assert Test.intensity.values[-1, -1, -1] == 1163
+
+def test_ESCHER_memmapFileObject():
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    with open(path, 'rb') as f:
+        Test = load_NLP(f, memmap=True)
+        assert f.tell() == 0
+        assert Test.intensity.values[-1, -1, -1] == 1163
+
+def test_ESCHER_indexCache(tmp_path):
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Parsed = load_NLP(path, frame_loading='none', index_cache=str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 1
+    Cached = load_NLP(path, index_cache=str(tmp_path))
+    assert Cached.GUN_HV.values[0] == Parsed.GUN_HV.values[0]
+    assert Cached.attrs["UPRISM_ST"] == 0.01975
+    assert Cached.intensity.values[-1, -1, -1] == 1163
+
+@pytest.mark.parametrize("readahead", [False, True])
+def test_ESCHER_iterFrames(readahead):
+    from pyLEEM.LEEMAnalysis import iter_frames
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    frames = list(iter_frames(path, readahead=readahead))
+    assert len(frames) == 1
+    index, meta_data, frame = frames[0]
+    assert index == 0
+    assert meta_data['GUN_HV'] == 15000.0
+    assert frame[-1, -1] == 1163
+
+def test_ESCHER_frameStatistics():
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Test = load_NLP(path, statistics=('min', 'max', 'mean', 'sum'), histogram_bins=64)
+    frame = Test.intensity.values[0]
+    assert Test.max_counts.values[0] == 48959 and Test.attrs['min_counts'] == 922
+    assert Test.sum_counts.values[0] == frame.sum(dtype=np.uint64)
+    assert Test.mean_counts.values[0] == pytest.approx(frame.mean())
+    assert Test.histogram.shape == (1, 64) and Test.histogram.values.sum() == frame.size
+
+def test_ESCHER_rawMetaData():
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Test = load_NLP(path, frame_loading='none', raw_strings=True, collapse_constant=True)
+    assert Test.GUN_HV_raw.values[0] == '+15000.000000'
+    assert Test.attrs['GUN_HV'] == 15000.0
+    assert Test.GUN.values[0] == 0.707469
+    assert Test.image_address.values[0] == 8330
+
+def test_parseTimestamps():
+    from pyLEEM.LEEMAnalysis import parse_timestamps, refine_time
+    time = parse_timestamps(['Sat Feb 23 18:56:58 2019', 'Sat Feb 23 18:56:58 2019', 'Sat Feb 23 18:56:59 2019'])
+    assert time.dtype == 'datetime64[ns]'
+    assert time[2] == np.datetime64('2019-02-23T18:56:59')
+    refined = refine_time(time, np.array([10.25, 10.75, 11.25]))
+    assert refined[1] == np.datetime64('2019-02-23T18:56:58.500')
+    assert (np.diff(refined) > np.timedelta64(0)).all()
+
+def test_ESCHER_readBuffer():
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    with open(path, "rb") as f:
+        data = f.read()
+        f.seek(0)
+        FromFile = load_NLP(f)
+        assert f.tell() == 0
+    FromBytes = load_NLP(memoryview(data))
+    assert 'path' not in FromBytes.attrs
+    assert FromBytes.intensity.values[-1, -1, -1] == FromFile.intensity.values[-1, -1, -1] == 1163
+    assert open_dataset(data, engine='pyLEEM').intensity.values[-1, -1, -1] == 1163
+
+def test_ESCHER_concurrentReads():
+    from concurrent.futures import ThreadPoolExecutor
+    from pyLEEM.NLPReader import NLPReader
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    with open(path, "rb") as f:
+        data = f.read()
+    rng = np.random.default_rng(0)
+    offsets = rng.integers(0, len(data), 2000)
+    sizes = rng.integers(1, 65536, 2000)
+    with NLPReader(path) as reader:
+        with ThreadPoolExecutor(16) as executor:
+            chunks = list(executor.map(lambda args: bytes(reader.pread(*args)), zip(sizes, offsets)))
+    assert all(chunk == data[o:o + s] for chunk, o, s in zip(chunks, offsets, sizes))
+
+    Test = open_dataset(path, engine='pyLEEM')
+    reference = Test.intensity.values
+    slices = [(rng.integers(0, 1000), rng.integers(0, 1200)) for _ in range(200)]
+    with ThreadPoolExecutor(16) as executor:
+        regions = list(executor.map(lambda yx: Test.intensity[0, yx[0]:yx[0] + 24, yx[1]:yx[1] + 80].values, slices))
+    assert all((region == reference[0, y:y + 24, x:x + 80]).all() for region, (y, x) in zip(regions, slices))
+
+def test_ESCHER_openMfNLP():
+    from pyLEEM.XArrayExt import open_mfNLP
+    path = os.path.join("tests","data","20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Test = open_mfNLP([path, path], workers=2)
+    assert Test.sizes['time'] == 2
+    assert list(Test.path.values) == [path, path]
+    assert Test.intensity.variable._in_memory is False
+    assert Test.intensity[1].values[-1, -1] == 1163
+    assert np.array_equal(Test.intensity.values[0], Test.intensity.values[1])
+    assert Test.attrs['UPRISM_ST'] == 0.01975
+
+def test_ESCHER_followNLP(tmp_path):
+    import threading
+    from pyLEEM.LEEMAnalysis import follow_NLP
+    path = os.path.join("tests","data","20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    with open(path, 'rb') as f:
+        data = f.read()
+    running = str(tmp_path / "running.nlp")
+    with open(running, 'wb') as f:
+        f.write(data[:100000])
+    assert list(follow_NLP(running, interval=0.01, timeout=0.1)) == []
+
+    def acquire():
+        with open(running, 'ab') as f:
+            for start in range(100000, len(data), 500000):
+                f.write(data[start:start + 500000])
+                f.flush()
+    writer = threading.Timer(0.1, acquire)
+    writer.start()
+    Test = [(index, meta_data['GUN_HV'], frame[-1, -1]) for index, meta_data, frame in
+            follow_NLP(running, interval=0.01, timeout=10)]
+    writer.join()
+    assert Test == [(0, 15000.0, 1163)]
+
+def test_ESCHER_instrument():
+    from pyLEEM.LEEMAnalysis import load_NLP
+    from pyLEEM.NLPStats import instrument
+    path = os.path.join("tests","data","20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    calls = []
+    with instrument(callback=lambda stage, *args: calls.append(stage)) as Test:
+        load_NLP(path)
+    assert set(Test.stages) == {'header', 'directory', 'metadata', 'io', 'statistics', 'assembly'}
+    assert Test.stages['io']['bytes_read'] == 4 + 1024 * 1280 * 2
+    assert Test.stages['header']['bytes_read'] == 4096
+    assert Test.stages['metadata']['bytes_read'] == 8330 - 4096
+    assert len(calls) == sum(stage['calls'] for stage in Test.stages.values())
+    with instrument(memory=True) as Test:
+        load_NLP(path)
+    assert Test.stages['assembly']['peak_memory'] >= 0
+    load_NLP(path, 'none')
+    assert 'assembly' in Test.stages and Test.stages['header']['calls'] == 1
+
+def test_lazyImport():
+    import subprocess
+    import sys
+    code = ("import sys, pyLEEM; assert not {'xarray', 'tqdm', 'pyLEEM._version'} & set(sys.modules); "
+            "import pyLEEM.XArrayExt; assert not {'tqdm', 'pyLEEM.LEEMAnalysis'} & set(sys.modules); "
+            "assert pyLEEM.NLPReader.NLPReader and pyLEEM.__version__")
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+def test_ESCHER_frameCache():
+    from pyLEEM.LEEMAnalysis import load_NLP
+    from pyLEEM.NLPCache import frame_cache
+    path = os.path.join("tests","data","20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    reference = load_NLP(path).intensity.values
+    frame_cache.clear()
+    frame_cache.max_bytes = 2 ** 24
+    try:
+        Test = open_dataset(path, engine='pyLEEM')
+        assert Test.intensity[0, -1, -1].values == 1163
+        assert np.array_equal(Test.intensity.values, reference)
+        assert np.array_equal(load_NLP(path).intensity.values, reference)
+        info = frame_cache.info()
+        assert (info['hits'], info['misses'], info['frames'], info['bytes']) == (2, 1, 1, reference.nbytes)
+        frame_cache.max_bytes = reference.nbytes - 1
+        assert frame_cache.info()['evictions'] == 1 and frame_cache.info()['frames'] == 0
+        load_NLP(path)
+        assert frame_cache.info()['frames'] == 0
+    finally:
+        frame_cache.max_bytes = 0
+        frame_cache.clear()
+
+def test_ESCHER_stackCache(tmp_path):
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests","data","20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    reference = load_NLP(path).intensity.values
+    Test = load_NLP(path, stack_cache=str(tmp_path))
+    assert not isinstance(Test.intensity.data, np.memmap)
+    Test = load_NLP(path, stack_cache=str(tmp_path))
+    assert isinstance(Test.intensity.data, np.memmap)
+    assert np.array_equal(Test.intensity.values, reference)
+    assert not isinstance(load_NLP(path, stack_cache=str(tmp_path), dtype=np.float32).intensity.data, np.memmap)
+    stack = [name for name in os.listdir(tmp_path) if name.endswith('.stack.npy.json')][0]
+    with open(tmp_path / stack, 'w') as f:
+        f.write('[]')
+    assert not isinstance(load_NLP(path, stack_cache=str(tmp_path)).intensity.data, np.memmap)
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_decodeDeltas(dtype):
+    from pyLEEM.LEEMAnalysis import decode_deltas
+    frames = np.random.default_rng(0).integers(0, np.iinfo(dtype).max, (6, 8, 10), dtype=dtype)
+    # the differences wrap around in the unsigned dtype
+    deltas = np.diff(frames.reshape(6, -1), axis=1, prepend=0).astype(dtype)
+    out = np.empty_like(frames)
+    bits = 8 * np.dtype(dtype).itemsize
+    assert decode_deltas([row.tobytes() for row in deltas], bits, out=out) is out
+    assert np.array_equal(out, frames)
+    with pytest.raises(ValueError):
+        decode_deltas([row.tobytes() for row in deltas], bits, out=out.astype(np.float32))
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_streamFrame(tmp_path, dtype):
+    from pyLEEM.LEEMAnalysis import load_NLP, stream_frame
+    from pyLEEM.NLPWriter import write_NLP
+    path = str(tmp_path / "synthetic.nlp")
+    frames = np.random.default_rng(0).integers(0, np.iinfo(dtype).max, (2, 101, 77), dtype=dtype)
+    write_NLP(path, frames)
+    Test = load_NLP(path, 'none')
+    bits = 8 * np.dtype(dtype).itemsize
+    for chunk_size in (7, 1000, 1 << 16):
+        out = np.empty((101, 77), dtype=dtype)
+        assert stream_frame(path, Test.image_address.values[1], bits, out, chunk_size=chunk_size) is out
+        assert np.array_equal(out, frames[1])
+    with pytest.raises(ValueError):
+        stream_frame(path, Test.image_address.values[1], bits, np.empty((100, 77), dtype=dtype))
+
+def test_XArrayBackendClose():
+    from pyLEEM.XArrayExt import open_mfNLP
+    if not os.path.isdir('/proc/self/fd'):
+        pytest.skip('needs /proc to count open files')
+    path = os.path.join("tests","data","20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+
+    def open_files():
+        count = 0
+        for fd in os.listdir('/proc/self/fd'):
+            try:
+                count += os.readlink(os.path.join('/proc/self/fd', fd)).endswith('.nlp')
+            except OSError:
+                pass
+        return count
+    before = open_files()
+    for _ in range(5):
+        with open_dataset(path, engine='pyLEEM') as Test:
+            assert Test.intensity[0, -1, -1].values == 1163
+        Test = open_mfNLP([path, path])
+        assert Test.intensity[1, -1, -1].values == 1163
+        Test.close()
+    assert open_files() == before
+
+def test_ESCHER_stackCacheStatistics(tmp_path):
+    from pyLEEM.LEEMAnalysis import load_NLP
+    path = os.path.join("tests","data","20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    for options in [{}, {'statistics': ('min', 'max', 'mean', 'sum'), 'histogram_bins': 16}]:
+        cold = load_NLP(path, stack_cache=str(tmp_path), **options)
+        warm = load_NLP(path, stack_cache=str(tmp_path), **options)
+        assert isinstance(warm.intensity.data, np.memmap)
+        assert set(cold.data_vars) == set(warm.data_vars) and set(cold.attrs) == set(warm.attrs)
+        assert cold.attrs['max_counts'] == warm.attrs['max_counts'] == 48959
+        reference = load_NLP(path, **options)
+        for name in reference.data_vars:
+            assert np.array_equal(reference[name].values, warm[name].values)
+            assert np.array_equal(reference[name].values, cold[name].values)
+
+@pytest.mark.parametrize("shape", [(40, 24, 32), (2, 1500, 1500)])
+def test_instrumentStages(tmp_path, shape):
+    from pyLEEM.LEEMAnalysis import load_NLP
+    from pyLEEM.NLPStats import instrument
+    from pyLEEM.NLPWriter import write_NLP
+    path = str(tmp_path / "synthetic.nlp")
+    frames = np.random.default_rng(0).integers(0, 4096, shape, dtype=np.uint16)
+    write_NLP(path, frames)
+    Test = load_NLP(path, 'none')
+    with instrument() as stats:
+        assert np.array_equal(load_NLP(path).intensity.values, frames)
+    with open(path, 'rb') as f:
+        data = f.read()
+    sizes = [4 + int.from_bytes(data[address:address + 4], 'little') for address in Test.image_address.values]
+    assert stats.stages['io']['calls'] == shape[0]
+    assert stats.stages['zlib']['bytes_read'] == 0 and stats.stages['delta']['calls'] > 0
+    assert stats.stages['zlib']['bytes_decompressed'] == frames.nbytes
+    assert stats.stages['io']['bytes_read'] == sum(sizes)
+
+def test_instrumentBatchedReadsOutsideZlib(tmp_path, monkeypatch):
+    import time
+    from pyLEEM import LEEMAnalysis
+    from pyLEEM.NLPStats import instrument
+    from pyLEEM.NLPWriter import write_NLP
+    path = str(tmp_path / "synthetic.nlp")
+    write_NLP(path, np.random.default_rng(0).integers(0, 4096, (20, 24, 32), dtype=np.uint16))
+    read_image_block = LEEMAnalysis.read_image_block
+
+    def slow_read_image_block(*args, **kwargs):
+        time.sleep(0.01)
+        return read_image_block(*args, **kwargs)
+    monkeypatch.setattr(LEEMAnalysis, 'read_image_block', slow_read_image_block)
+    with instrument() as stats:
+        LEEMAnalysis.load_NLP(path)
+    assert stats.stages['zlib']['seconds'] < 0.1
+
+def test_stackCacheSelection(tmp_path, monkeypatch):
+    from pyLEEM import LEEMAnalysis
+    from pyLEEM.NLPWriter import write_NLP
+    path = str(tmp_path / "synthetic.nlp")
+    frames = np.random.default_rng(0).integers(0, 4096, (50, 64, 64), dtype=np.uint16)
+    write_NLP(path, frames)
+    LEEMAnalysis.load_NLP(path, stack_cache=str(tmp_path))
+    stack_statistics = LEEMAnalysis.stack_statistics
+    shapes = []
+
+    def recording_stack_statistics(intensity, *args):
+        shapes.append(intensity.shape)
+        return stack_statistics(intensity, *args)
+    monkeypatch.setattr(LEEMAnalysis, 'stack_statistics', recording_stack_statistics)
+    Test = LEEMAnalysis.load_NLP(path, stack_cache=str(tmp_path), frames=[3], statistics=('mean',))
+    assert shapes == [(1, 64, 64)]
+    assert np.array_equal(Test.intensity.values, frames[[3]])
+    assert Test.mean_counts.values[0] == frames[3].mean()
+
+def test_indexCacheConcurrentWriters(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from pyLEEM.LEEMAnalysis import load_NLP
+    from pyLEEM.NLPCache import read_index_cache, write_index_cache
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    Test = load_NLP(path, frame_loading='none')
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda _: write_index_cache(Test, str(tmp_path)), range(32)))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+    assert read_index_cache(path, str(tmp_path)).GUN_HV.values[0] == 15000.0
+
+def test_stackCacheConcurrentWriters(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from pyLEEM.NLPCache import read_stack_cache, write_stack_cache
+    path = os.path.join("tests", "data", "20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    intensity = np.random.default_rng(0).integers(0, 4096, (4, 64, 64), dtype=np.uint16)
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda _: write_stack_cache(path, intensity, str(tmp_path), 'digest',
+                                                  {'max_counts': intensity.max(axis=(1, 2))}), range(32)))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+    stack, statistics = read_stack_cache(path, str(tmp_path), 'digest')
+    assert np.array_equal(stack, intensity)
+    assert np.array_equal(statistics['max_counts'], intensity.max(axis=(1, 2)))
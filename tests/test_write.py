@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import pytest
+from datetime import datetime
+from xarray import open_dataset
+from pyLEEM.LEEMAnalysis import load_NLP
+from pyLEEM.NLPWriter import write_NLP
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+@pytest.mark.parametrize("compression", [True, False])
+def test_write_NLP(tmp_path, dtype, compression):
+    path = str(tmp_path / "synthetic.nlp")
+    frames = np.random.default_rng(0).integers(0, np.iinfo(dtype).max, (5, 24, 32), dtype=dtype)
+    assert write_NLP(path, frames, compression=compression, attrs={'GUN': 0.707469},
+                     meta_data={'GUN_HV': 15000., 'STV': [1., 2., 3., 4., 5.], 'LNS': 'Bright'},
+                     start_time=datetime(2019, 2, 23, 18, 56, 58), frame_interval=0.5) == 5
+    Test = load_NLP(path)
+    assert np.array_equal(Test.intensity.values, frames)
+    assert Test.intensity.dtype == dtype
+    assert (Test.compression_code.values == (3 if compression else 0)).all()
+    assert list(Test.STV.values) == [1., 2., 3., 4., 5.]
+    assert Test.GUN_HV.values[0] == 15000.0 and Test.LNS.values[0] == 'Bright'
+    assert Test.time.values[1] == np.datetime64('2019-02-23T18:56:58.5')
+    assert Test.attrs['GUN'] == 0.707469 and Test.attrs['number_of_frames'] == 5
+    assert np.array_equal(open_dataset(path, engine='pyLEEM').intensity[2:4, 3].values, frames[2:4, 3])
+
+def test_write_NLP_generator(tmp_path):
+    path = str(tmp_path / "synthetic.nlp")
+    reference = load_NLP(os.path.join("tests","data","20190223_185646_5.7um_349.0_test_ESCHER.nlp"))
+    write_NLP(path, (frame for frame in reference.intensity.values))
+    assert np.array_equal(load_NLP(path).intensity.values, reference.intensity.values)
+
+def test_write_NLP_directory(tmp_path):
+    from pyLEEM.LEEMAnalysis import read_directory
+    path = str(tmp_path / "synthetic.nlp")
+    reference_path = os.path.join("tests","data","20190223_185646_5.7um_349.0_test_ESCHER.nlp")
+    reference = load_NLP(reference_path)
+    write_NLP(path, reference.intensity.values, compression=False, bits_per_pixel=16)
+    Test = load_NLP(path, frame_loading='none')
+    directory = read_directory(path, Test.attrs['directory_position'])
+    reference_directory = read_directory(reference_path, reference.attrs['directory_position'])
+    for name in ('frame_number', 'content_code'):
+        assert np.array_equal(directory[name], reference_directory[name])
+    assert directory['block_start_location'][-1] == Test.attrs['directory_position']
+    assert Test.attrs['number_of_frames'] == 1
+
+def test_follow_write_NLP(tmp_path):
+    import threading
+    import time
+    from pyLEEM.LEEMAnalysis import follow_NLP
+    path = str(tmp_path / "running.nlp")
+    frames = np.random.default_rng(0).integers(0, 65535, (6, 24, 32), dtype=np.uint16)
+
+    def acquire():
+        for frame in frames:
+            time.sleep(0.05)
+            yield frame
+    writer = threading.Thread(target=write_NLP, args=(path, acquire()))
+    writer.start()
+    while not os.path.exists(path):
+        time.sleep(0.001)
+    start = time.monotonic()
+    Test = [(index, frame.copy()) for index, meta_data, frame in follow_NLP(path, interval=0.01, timeout=10)]
+    writer.join()
+    assert time.monotonic() - start < 5
+    assert [index for index, frame in Test] == list(range(6))
+    assert all(np.array_equal(frame, frames[index]) for index, frame in Test)